@@ -0,0 +1,103 @@
+__author__ = 'colby'
+
+import hashlib
+import json
+import os
+import sdl_ll
+
+PAGE_SIZE = 2048  # every renderer worth mentioning supports textures at least this big
+PADDING = 1  # transparent pixels between packed images
+LAYOUT_FILE = ".atlas-layout.json"
+LAYOUT_VERSION = 1
+
+
+def pack(sizes, page_size=PAGE_SIZE, padding=PADDING):
+	# shelf packing: tallest images first, left to right along horizontal shelves, moving on to the next page when a
+	# page fills up. images too big for a page get a page of their own.
+	# returns ({name: (page, x, y, w, h)}, [(page width, page height)])
+	entries = {}
+	pages = []
+	current = None  # the page that's being filled
+	x = y = shelf_height = 0
+	for name in sorted(sizes, key=lambda name: (-sizes[name][1], -sizes[name][0], name)):
+		w, h = sizes[name]
+		if w > page_size or h > page_size:
+			entries[name] = len(pages), 0, 0, w, h
+			pages.append((w, h))
+			continue
+		if current is not None and x + w > page_size:
+			x, y, shelf_height = 0, y + shelf_height + padding, 0
+		if current is None or y + h > page_size:
+			current = len(pages)
+			pages.append((0, 0))
+			x = y = shelf_height = 0
+		entries[name] = current, x, y, w, h
+		pages[current] = max(pages[current][0], x + w), max(pages[current][1], y + h)
+		x += w + padding
+		shelf_height = max(shelf_height, h)
+	return entries, pages
+
+
+def asset_key(directory, names):
+	# changes whenever any of the assets do
+	digest = hashlib.sha1()
+	for name in names:
+		with open(os.path.join(directory, name), "rb") as f:
+			digest.update(name.encode() + b"\0" + hashlib.sha1(f.read()).digest())
+	return digest.hexdigest()
+
+
+def load_layout(directory, names, sizes):
+	# returns the packed layout for these assets, from the cache next to them when it's still valid
+	key = asset_key(directory, names)
+	path = os.path.join(directory, LAYOUT_FILE)
+	try:
+		with open(path, "r") as f:
+			cached = json.load(f)
+		if cached["version"] == LAYOUT_VERSION and cached["key"] == key:
+			return dict((name, tuple(entry)) for name, entry in cached["entries"].items()), [tuple(page) for page in cached["pages"]]
+	except (OSError, ValueError, KeyError):
+		pass  # missing, unreadable, or from an older version
+	entries, pages = pack(sizes())
+	try:
+		with open(path + ".tmp", "w") as f:
+			json.dump({"version": LAYOUT_VERSION, "key": key, "entries": entries, "pages": pages}, f)
+		os.replace(path + ".tmp", path)
+	except OSError:
+		pass  # not being able to cache it is fine
+	return entries, pages
+
+
+class Atlas:
+	# every image in a directory, packed into as few textures as possible, so that drawing different images doesn't
+	# keep switching textures (and so that batches stay long). load(name) has to return the image's Surface.
+	def __init__(self, renderer, directory, load, names=None):
+		if names is None:
+			names = [name for name in os.listdir(directory) if name.lower().endswith(".png") and not name.startswith(".")]
+		names = sorted(names)
+		entries, page_sizes = load_layout(directory, names, lambda: dict((name, load(name).get_size()) for name in names))
+		pages = [sdl_ll.create_surface(w, h) for w, h in page_sizes]
+		for name, (page, x, y, w, h) in entries.items():
+			pages[page].blit(load(name), x, y)
+		self.pages = []
+		for surface in pages:
+			self.pages.append(surface.to_texture(renderer))
+			surface.destroy()
+		self.entries = dict((name, (self.pages[page], x, y, w, h)) for name, (page, x, y, w, h) in entries.items())
+
+	def lookup(self, name, srcrect):
+		# the texture holding the image, and where srcrect (or the whole image, if it's None) is within it
+		entry = self.entries.get(name)
+		if entry is None:
+			return None
+		texture, x, y, w, h = entry
+		if srcrect is None:
+			return texture, (x, y, w, h)
+		sx, sy, sw, sh = srcrect
+		return texture, (x + sx, y + sy, sw, sh)
+
+	def destroy(self):
+		for texture in self.pages:
+			texture.destroy()
+		self.pages = []
+		self.entries = {}
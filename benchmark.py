@@ -0,0 +1,372 @@
+__author__ = 'colby'
+# headless benchmarks for the engine: nothing here opens a window, so it can run on a machine without a display.
+# results come out as JSON, and can be compared against an earlier run to catch regressions:
+#   python benchmark.py --output before.json
+#   python benchmark.py --compare before.json
+
+import argparse
+import array
+import json
+import math
+import platform
+import random
+import sys
+import time
+
+import entity
+import entity_store
+import headless
+import sdle
+import shard
+import timers
+import world
+
+FLOOR = (1, 0)
+WALL = (0, 0)
+SOLID = [(0, 0), (2, 0)]
+MAP_SIZES = ((20, 15), (200, 150), (2000, 2000))
+ENTITY_COUNTS = (10, 100, 1000)
+RENDER_ENTITY_COUNTS = (1000, 10000)
+TIMER_COUNTS = (10, 1000, 100000)
+SIMULATED_SECONDS = 60
+SHARD_LAYOUTS = ((1, 1), (2, 1), (2, 2))
+RAY_COUNT = 1000
+SEED = 1234
+
+Mover = entity.EntityType(
+	entity.RenderImage("pyramid_small.png"),
+	entity.GridCollider(),
+	lambda x, y, vx, vy: entity.PositionVelocity(x, y, vx, vy))
+
+Drifter = entity.EntityType(
+	entity.RenderImage("pyramid_small.png"),
+	lambda x, y, vx, vy: entity.PositionVelocity(x, y, vx, vy))
+
+
+
+class Wander:
+	# picks a new random direction every period seconds
+	def __init__(self, speed, period, rng):
+		self.speed = speed
+		self.period = period
+		self.rng = rng
+
+	def on_add(self, ent, world):
+		ent.wander_timer = world.time_provider.add_interval(self.period, self.turn, ent)
+
+	def on_remove(self, ent, world):
+		ent.wander_timer.cancel()
+
+	def turn(self, ent):
+		angle = self.rng.uniform(0, 2 * math.pi)
+		ent.set_velocity(self.speed * math.cos(angle), self.speed * math.sin(angle))
+
+Wanderer = entity.EntityType(
+	entity.RenderImage("pyramid_small.png"),
+	entity.GridCollider(),
+	entity.EntityCollider(),
+	lambda x, y: entity.PositionVelocity(x, y, 0, 0),
+	lambda rng: Wander(64, 1.0, rng))
+_wander_rng = random.Random(SEED)
+
+
+def wanderer(x, y):
+	# for handing to a ShardedWorld as an entity kind
+	return Wanderer(x, y, _wander_rng)
+
+
+def generate_map(width, height, seed=SEED):
+	# a walled-in map with randomly placed blocks of wall, covering about an eighth of it
+	rng = random.Random(seed)
+	solid = bytearray(width * height)  # column by column, like World.cells
+	for x in range(width):
+		solid[x * height] = solid[x * height + height - 1] = 1
+	solid[:height] = solid[-height:] = b"\1" * height
+	for _ in range(width * height // 50):
+		bw, bh = rng.randint(1, 4), rng.randint(1, 4)
+		bx, by = rng.randrange(width), rng.randrange(height)
+		for x in range(bx, min(bx + bw, width)):
+			solid[x * height + by:x * height + min(by + bh, height)] = b"\1" * (min(by + bh, height) - by)
+	# icon ids: 0 is None, 1 is the floor, and 2 is the wall
+	return array.array("H", list(solid.translate(bytes.maketrans(b"\0\1", b"\1\2"))))
+
+
+def build_world(width, height, tileset, loop, ray_caster=None, seed=SEED):
+	cells = generate_map(width, height, seed)
+	return world.World.from_cells(width, height, [None, FLOOR, WALL], cells, tileset, SOLID, loop, ray_caster)
+
+
+def check_corner_sweeps(tileset, loop):
+	# a box sitting exactly on the corner of a wall has to get stopped when it moves diagonally into it, and not when it
+	# moves away along either axis. runs before the collider benchmarks, so that a fast but wrong sweep can't pass.
+	cw, ch = tileset.cell_size()
+	cells = array.array("H", [2 if x in (0, 5) or y in (0, 5) or (x, y) == (2, 3) else 1 for x in range(6) for y in range(6)])
+	for caster in (world.SegmentRayCaster(), world.GridRayCaster()):
+		w = world.World.from_cells(6, 6, [None, FLOOR, WALL], cells, tileset, SOLID, loop, caster)
+		center = 3 * cw + 8, 3 * ch - 8  # its bottom left corner is on the top right corner of the wall at (2, 3)
+		assert w.sweep_box(center, (16, 16), (-14.26, 46.28), entity.FUDGE_FACTOR)[0] == 0, caster
+		assert w.sweep_box(center, (16, 16), (14.26, 46.28), entity.FUDGE_FACTOR)[0] > 0, caster
+		assert w.sweep_box(center, (16, 16), (-14.26, -46.28), entity.FUDGE_FACTOR)[0] > 0, caster
+
+
+def open_cells(w, count, rng):
+	# random cells that aren't solid, as pixel coordinates of their centers
+	cw, ch = w.tileset.cell_size()
+	out = []
+	while len(out) < count:
+		x, y = rng.randrange(w.width), rng.randrange(w.height)
+		if not w.is_solid(x, y):
+			out.append(((x + 0.5) * cw, (y + 0.5) * ch))
+	return out
+
+
+def measure(fn, number, repeat):
+	# returns the seconds per call of each of the repeats
+	out = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		for _ in range(number):
+			fn()
+		out.append((time.perf_counter() - start) / number)
+	return out
+
+
+class Suite:
+	def __init__(self, sizes, repeat, only=None):
+		self.sizes = sizes
+		self.repeat = repeat
+		self.only = only
+		self.results = []
+		self.loop = sdle.EventLoop()
+		self.tileset = world.Tileset("tileset2.png", 4, 4)
+
+	def record(self, name, params, timings, ops=1):
+		timings = sorted(t / ops for t in timings)
+		result = {"name": name, "params": params, "best": timings[0], "median": timings[len(timings) // 2], "repeat": len(timings)}
+		self.results.append(result)
+		print("%-20s %-40s %12.3f us" % (name, format_params(params), result["median"] * 1e6), file=sys.stderr)
+
+	def wants(self, name):
+		return self.only is None or name in self.only
+
+	def run(self):
+		for width, height in self.sizes:
+			size = "%dx%d" % (width, height)
+			if self.wants("recalculate_cache"):
+				self.bench_recalculate_cache(size, build_world(width, height, self.tileset, self.loop))
+			if self.wants("ray_cast"):
+				for name, caster in (("segment", world.SegmentRayCaster()), ("grid", world.GridRayCaster())):
+					self.bench_ray_cast(size, name, build_world(width, height, self.tileset, self.loop, caster))
+			if self.wants("render"):
+				self.bench_render(size, build_world(width, height, self.tileset, self.loop))
+		if self.wants("render_entities"):
+			for count in RENDER_ENTITY_COUNTS:
+				self.bench_render_entities(count, False)
+				if entity_store.available():
+					self.bench_render_entities(count, True)
+		if self.wants("grid_collider"):
+			check_corner_sweeps(self.tileset, self.loop)
+			for count in ENTITY_COUNTS:
+				self.bench_grid_collider(count)
+		if self.wants("pump"):
+			for count in TIMER_COUNTS:
+				self.bench_pump(count)
+		if self.wants("simulate"):
+			for count in ENTITY_COUNTS:
+				self.bench_simulate(count)
+		if self.wants("simulate_sharded"):
+			for columns, rows in SHARD_LAYOUTS:
+				self.bench_simulate_sharded(ENTITY_COUNTS[-1], columns, rows)
+		return self.results
+
+	def settle(self):
+		# lets anything that got scheduled as a side effect run, like on_update_map
+		self.loop.run_timers(self.loop.now())
+
+	def bench_recalculate_cache(self, size, w):
+		def full():
+			w.dirty_cache()
+			self.settle()
+			w.recalculate_cache()
+		self.record("recalculate_cache", {"map": size, "mode": "full"}, measure(full, 1, self.repeat))
+		rng = random.Random(SEED)
+
+		def incremental():
+			x, y = rng.randrange(1, w.width - 1), rng.randrange(1, w.height - 1)
+			w.update_icon_only(x, y, FLOOR if w.is_solid(x, y) else WALL)
+			self.settle()
+			w.recalculate_cache()
+		self.record("recalculate_cache", {"map": size, "mode": "incremental"}, measure(incremental, 100, self.repeat))
+
+	def bench_ray_cast(self, size, caster, w):
+		rng = random.Random(SEED)
+		rays = []
+		for origin in open_cells(w, RAY_COUNT, rng):
+			rays.append((origin, (rng.uniform(-1, 1), rng.uniform(-1, 1)), rng.random() < 0.5))
+		w.ray_cast(rays[0][0], rays[0][1], rays[0][2], entity.FUDGE_FACTOR)  # builds the cache, if it's needed
+
+		def cast_all():
+			for origin, direction, is_vertical in rays:
+				w.ray_cast(origin, direction, is_vertical, entity.FUDGE_FACTOR)
+		self.record("ray_cast", {"map": size, "caster": caster}, measure(cast_all, 1, self.repeat), len(rays))
+
+	def bench_render(self, size, w):
+		window = headless.RecordingWindow()
+		rng = random.Random(SEED)
+		for x, y in open_cells(w, 50, rng):
+			w.add_entity(Mover(x, y, 0, 0))
+		self.settle()
+		cw, ch = self.tileset.cell_size()
+		ww, wh = window.get_size()
+		max_x, max_y = max(w.width * cw - ww, 0), max(w.height * ch - wh, 0)
+		self.record("render", {"map": size, "frame": "first"}, measure(lambda: w.render(window, 0, 0), 1, 1))
+		# sweep the viewport diagonally across the map, the way a scrolling camera would
+		frames = 100
+		state = {"frame": 0}
+
+		def scroll():
+			t = state["frame"] % frames / float(frames)
+			state["frame"] += 1
+			w.render(window, -round(max_x * t), -round(max_y * t))
+		self.record("render", {"map": size, "frame": "scrolling"}, measure(scroll, frames, self.repeat))
+		self.record("render", {"map": size, "frame": "static"}, measure(lambda: w.render(window, 0, 0), frames, self.repeat))
+		w.release_chunks()
+
+	def bench_render_entities(self, count, stored):
+		# a viewport that shows the whole map, so that every entity gets drawn
+		w = build_world(200, 150, self.tileset, self.loop)
+		cw, ch = self.tileset.cell_size()
+		window = headless.RecordingWindow(w.width * cw, w.height * ch)
+		make = Drifter
+		if stored:
+			store = entity_store.EntityStore()
+			w.set_entity_store(store)
+			make = lambda *args: store.create(Drifter, *args)
+		rng = random.Random(SEED)
+		for x, y in open_cells(w, count, rng):
+			w.add_entity(make(x, y, rng.uniform(-64, 64), rng.uniform(-64, 64)))
+		self.settle()
+		w.render(window, 0, 0)
+		self.record("render_entities", {"entities": count, "store": "numpy" if stored else "none"}, measure(lambda: w.render(window, 0, 0), 10, self.repeat))
+		w.release_chunks()
+
+	def bench_grid_collider(self, count):
+		w = build_world(200, 150, self.tileset, self.loop)
+		rng = random.Random(SEED)
+		ents = [w.add_entity(Mover(x, y, 0, 0)) for x, y in open_cells(w, count, rng)]
+		self.settle()
+		w.recalculate_cache()  # so that the first sweep doesn't pay for building it
+		speed = 64
+
+		def update_all():
+			for ent in ents:
+				ent.pos_vel_time = ent.pos_vel_time[:2] + (rng.uniform(-speed, speed), rng.uniform(-speed, speed), ent.now)
+				ent.on_kinematic_update()
+		self.record("grid_collider", {"entities": count}, measure(update_all, 1, self.repeat), count)
+		for ent in ents:
+			if ent.wall_timer:
+				ent.wall_timer.cancel()
+
+	def bench_pump(self, count):
+		loop = sdle.EventLoop()
+		rng = random.Random(SEED)
+		fired = []
+		# with everything still pending, a pump should only cost a peek at the heap
+		timers = [loop.add_timer(3600 + rng.random(), fired.append, i) for i in range(count)]
+		self.record("pump", {"timers": count, "due": 0}, measure(loop.pump, 1000, self.repeat))
+		for timer in timers:
+			timer.cancel()
+
+		def fire_all():
+			now = loop.now()
+			for i in range(count):
+				loop.add_timer_at(now - rng.random(), fired.append, i)
+			loop.pump()
+			assert len(fired) == count
+			del fired[:]
+		self.record("pump", {"timers": count, "due": count}, measure(fire_all, 1, self.repeat), count)
+
+	def bench_simulate(self, count):
+		# wall time per simulated second of wandering entities, run ahead on a virtual clock
+		clock = timers.VirtualClock()
+		w = build_world(200, 150, self.tileset, clock)
+		rng = random.Random(SEED)
+		for x, y in open_cells(w, count, rng):
+			w.add_entity(Wanderer(x, y, rng))
+		clock.run_for(1)
+		self.record("simulate", {"entities": count}, measure(lambda: clock.run_for(SIMULATED_SECONDS), 1, self.repeat), SIMULATED_SECONDS)
+
+	def bench_simulate_sharded(self, count, columns, rows):
+		template = build_world(200, 150, self.tileset, timers.VirtualClock())
+		sharded = shard.ShardedWorld(template, {"wanderer": "benchmark.wanderer"}, columns, rows)
+		try:
+			rng = random.Random(SEED)
+			for x, y in open_cells(template, count, rng):
+				sharded.add_entity("wanderer", x, y)
+			sharded.run_for(1)
+			timings = measure(lambda: sharded.run_for(SIMULATED_SECONDS), 1, self.repeat)
+			self.record("simulate_sharded", {"entities": count, "shards": "%dx%d" % (columns, rows)}, timings, SIMULATED_SECONDS)
+		finally:
+			sharded.close()
+
+
+def format_params(params):
+	return " ".join("%s=%s" % item for item in sorted(params.items()))
+
+
+def result_key(result):
+	return result["name"], format_params(result["params"])
+
+
+def compare(results, baseline, threshold):
+	# prints how each result changed relative to the baseline, and returns the ones that got slower than the threshold
+	old = dict((result_key(result), result) for result in baseline["results"])
+	regressions = []
+	for result in results:
+		key = result_key(result)
+		if key not in old:
+			print("%-20s %-40s         (new)" % key, file=sys.stderr)
+			continue
+		ratio = result["median"] / old[key]["median"] if old[key]["median"] else float("inf")
+		flag = ""
+		if ratio > threshold:
+			regressions.append(result)
+			flag = "  REGRESSION"
+		print("%-20s %-40s %12.2fx%s" % (key + (ratio, flag)), file=sys.stderr)
+	return regressions
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Runs the headless engine benchmarks.")
+	parser.add_argument("--quick", action="store_true", help="skip the largest map, and repeat less")
+	parser.add_argument("--repeat", type=int, default=None, help="how many times to repeat each measurement")
+	parser.add_argument("--only", action="append", help="only run this benchmark (can be given more than once)")
+	parser.add_argument("--output", help="where to write the JSON results (defaults to stdout)")
+	parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+	parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio that counts as a regression")
+	args = parser.parse_args(argv)
+
+	sizes = MAP_SIZES[:-1] if args.quick else MAP_SIZES
+	repeat = args.repeat or (3 if args.quick else 7)
+	results = Suite(sizes, repeat, args.only).run()
+	out = {
+		"python": platform.python_implementation() + " " + platform.python_version(),
+		"platform": platform.platform(),
+		"time": time.time(),
+		"results": results,
+	}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(out, f, indent=1)
+	else:
+		json.dump(out, sys.stdout, indent=1)
+		print()
+	if args.compare:
+		with open(args.compare, "r") as f:
+			baseline = json.load(f)
+		if compare(results, baseline, args.threshold):
+			return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,50 @@
+__author__ = 'colby'
+
+
+class UniformGrid:
+	# buckets entities by the (swept) bounding boxes they were last given, so that only nearby pairs get checked
+	def __init__(self, cell_size):
+		self.cell_size = cell_size
+		self.cells = {}
+		self.ranges = {}
+
+	def _range(self, bounds):
+		x1, y1, x2, y2 = bounds
+		cs = self.cell_size
+		return int(x1 // cs), int(y1 // cs), int(x2 // cs), int(y2 // cs)
+
+	def update(self, ent, bounds):
+		new_range = self._range(bounds)
+		if self.ranges.get(ent) == new_range:
+			return
+		self.remove(ent)
+		self.ranges[ent] = new_range
+		cx1, cy1, cx2, cy2 = new_range
+		for cx in range(cx1, cx2 + 1):
+			for cy in range(cy1, cy2 + 1):
+				cell = self.cells.get((cx, cy))
+				if cell is None:
+					cell = self.cells[cx, cy] = set()
+				cell.add(ent)
+
+	def remove(self, ent):
+		old_range = self.ranges.pop(ent, None)
+		if old_range is None:
+			return
+		cx1, cy1, cx2, cy2 = old_range
+		for cx in range(cx1, cx2 + 1):
+			for cy in range(cy1, cy2 + 1):
+				cell = self.cells[cx, cy]
+				cell.discard(ent)
+				if not cell:
+					del self.cells[cx, cy]
+
+	def query(self, bounds):
+		found = set()
+		cx1, cy1, cx2, cy2 = self._range(bounds)
+		for cx in range(cx1, cx2 + 1):
+			for cy in range(cy1, cy2 + 1):
+				cell = self.cells.get((cx, cy))
+				if cell:
+					found |= cell
+		return found
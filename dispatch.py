@@ -0,0 +1,43 @@
+__author__ = 'colby'
+
+import functools
+
+_tables = {}
+
+
+def build_table(components):
+	# message name -> indices of the components whose classes handle it, computed once per combination of classes
+	classes = tuple(type(component) for component in components)
+	table = _tables.get(classes)
+	if table is None:
+		table = {}
+		for i, cls in enumerate(classes):
+			for name in dir(cls):
+				if not name.startswith("_") and callable(getattr(cls, name)):
+					table.setdefault(name, []).append(i)
+		table = _tables[classes] = dict((name, tuple(indices)) for name, indices in table.items())
+	return table
+
+
+def bind(table, components):
+	# message name -> tuple of bound handlers
+	return dict((name, tuple(getattr(components[i], name) for i in indices)) for name, indices in table.items())
+
+
+def ignore(*args):
+	pass
+
+
+def sender(owner, handlers):
+	# a callable that posts a message to the given handlers, stopping at the first one that returns something truthy
+	if not handlers:
+		return ignore
+	if len(handlers) == 1:
+		return functools.partial(handlers[0], owner)
+
+	def send(*args):
+		for handler in handlers:
+			out = handler(owner, *args)
+			if out:
+				return out
+	return send
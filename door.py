@@ -9,6 +9,8 @@ TILE_DOOR_CLOSED = (2, 0)
 
 
 class DoorGUI(gui.GUI):
+	images = ("door_open.png", "door_closed.png")
+
 	def __init__(self, ent):
 		self.ent = ent
 
@@ -16,10 +18,12 @@ class DoorGUI(gui.GUI):
 		self.ent.is_open = not self.ent.is_open
 
 	def render(self, renderer, cx, cy):
-		return renderer.draw_image_centered("door_open.png" if self.ent.is_open else "door_closed.png", None, cx, cy)
+		return renderer.draw_image_centered(self.images[0] if self.ent.is_open else self.images[1], None, cx, cy)
 
 
 class DoorComponent:
+	images = DoorGUI.images  # for preloading
+
 	def __init__(self, open, closed):
 		self.open_icon = open
 		self.closed_icon = closed
@@ -1,62 +1,58 @@
 __author__ = 'colby'
 
 import math
+import dispatch
 import sdle
 import tile
 
 
 class Entity:
 	# note: get_velocity must be constant between posts of on_kinematic_update
-	valid_messages = ("on_add", "get_pos", "on_kinematic_update", "get_velocity", "get_size", "on_collide", "set_velocity", "control_move", "control_click", "on_update_map", "open_gui")
+	valid_messages = ("on_add", "get_pos", "on_kinematic_update", "get_velocity", "get_size", "on_collide", "set_velocity", "control_move", "control_click", "on_update_map", "open_gui", "on_remove", "move_to")
 
 	def __init__(self, *components):
 		if len(components) == 1 and type(components[0]) == list:
 			components = components[0]
 		self.components = components
 		self.world = None  # gets set by World
-		self.rendering_components = [comp for comp in components if hasattr(comp, "render")]
-		self.position_components = [comp for comp in components if hasattr(comp, "get_pos")]
-		assert self.position_components, "No positioning component for entity!"
-		if len(self.position_components) == 1:
-			self.get_pos = lambda now: self.position_components[0].get_pos(self, now)
-
-	def get_pos(self, now):
-		for comp in self.position_components:
-			out = comp.get_pos(self, now)
-			if out:
-				return out
+		# every message goes straight to the components that handle it, without looking anything up per call
+		self.handlers = dispatch.bind(dispatch.build_table(components), components)
+		assert "get_pos" in self.handlers, "No positioning component for entity!"
+		self.renderers = self.handlers.get("render", ())
+		for name in Entity.valid_messages:
+			setattr(self, name, dispatch.sender(self, self.handlers.get(name, ())))
+
+	@property
+	def now(self):
+		return self.world.time_provider.now()
 
 	def render(self, renderer, rx, ry, now):
-		for comp in self.rendering_components:
-			if comp.render(renderer, self, rx, ry, now):
+		for render in self.renderers:
+			if render(renderer, self, rx, ry, now):
 				return
 
 	def post_event(self, name, *args):
-		for component in self.components:
-			if hasattr(component, name):
-				out = getattr(component, name)(self, *args)
-				if out:
-					return out
-
-	def __getattr__(self, name):
-		if name in Entity.valid_messages:
-			return lambda *args: self.post_event(name, *args)
-		if name == "now":
-			return self.world.time_provider.now()
-		raise AttributeError("%r object has no attribute %r" % (self.__class__, name))
+		for handler in self.handlers.get(name, ()):
+			out = handler(self, *args)
+			if out:
+				return out
 
 
 class RenderImage:
 	def __init__(self, image, srcrect=None, size=None):
 		self.image = image
 		self.srcrect = srcrect
-		self.size = size if size else (srcrect[2:4] if srcrect else sdle.get_image_size(image))
+		# the image's own size gets looked up when it's first needed, so that defining entity types doesn't have to wait
+		# for the image to be loaded
+		self.size = size if size else (srcrect[2:4] if srcrect else None)
 
 	def render(self, renderer, ent, rx, ry, now):
 		px, py = ent.get_pos(now)
 		renderer.draw_image_centered(self.image, self.srcrect, px + rx, py + ry)
 
 	def get_size(self, ent):
+		if self.size is None:
+			self.size = sdle.get_image_size(self.image)
 		return self.size
 
 
@@ -119,6 +115,8 @@ class Controllable:
 		tent = ent.world[cx, cy]
 		if isinstance(tent, tile.Tile):
 			tent.on_click(ent, rx, ry)
+		else:
+			ent.move_to(cx, cy)
 
 	def open_gui(self, ent, gui):
 		self.gui_cb(gui)
@@ -128,38 +126,126 @@ FUDGE_FACTOR = 0.001
 
 class GridCollider:
 	def on_add(self, ent, world):
-		ent.last_timer_cancel = None
-		world.time_provider.on_next(self.on_kinematic_update, ent)
+		ent.wall_timer = world.time_provider.on_next(self.on_kinematic_update, ent)
+
+	def on_remove(self, ent, world):
+		if ent.wall_timer:
+			ent.wall_timer.cancel()
+			ent.wall_timer = None
 
 	def on_kinematic_update(self, ent):
-		if ent.last_timer_cancel:
-			ent.last_timer_cancel()
-			ent.last_timer_cancel = None
-		# TODO: don't assume that the bounding box of the moving object is smaller than the wall bounding box
+		if ent.wall_timer:
+			ent.wall_timer.cancel()
+			ent.wall_timer = None
 		w, h = ent.get_size()
 		x, y = ent.get_pos(ent.now)
 		vx, vy = ent.get_velocity()
-		print("UPDATE", "%s,%s" % (x, y), "%sx%s" % (w, h), "%s,%s" % (vx, vy))
-		distance = float("inf")
-		speed = math.sqrt(vx * vx + vy * vy)
-		if speed == 0:
+		if vx == 0 and vy == 0:
 			return
-		direction = vx / speed, vy / speed
-		colliding_horizontally, colliding_vertically = False, False
-		for corner in ((x - w/2, y - h/2), (x + w/2, y - h/2), (x - w/2, y + h/2), (x + w/2, y + h/2)):
-			# trace each component separately (as in, only look for vertical lines and then only look for horizontal lines)
-			distance_horizontal = ent.world.ray_cast(corner, direction, is_vertical=False, fudge_factor=FUDGE_FACTOR)
-			distance_vertical = ent.world.ray_cast(corner, direction, is_vertical=True, fudge_factor=FUDGE_FACTOR)
-			distance = min(distance, distance_horizontal, distance_vertical)
-			if distance_horizontal <= FUDGE_FACTOR:
-				colliding_horizontally = True
-			if distance_vertical <= FUDGE_FACTOR:
-				colliding_vertically = True
-		time = distance / speed
+		time, colliding_horizontally, colliding_vertically = ent.world.sweep_box((x, y), (w, h), (vx, vy), FUDGE_FACTOR)
 		if colliding_vertically or colliding_horizontally:
 			ent.on_collide(colliding_horizontally, colliding_vertically)
 		else:
-			ent.last_timer_cancel = ent.world.time_provider.add_timer(time, ent.on_kinematic_update)
+			ent.wall_timer = ent.world.time_provider.add_timer(time, ent.on_kinematic_update)
+
+
+PAIR_HORIZON = 2  # seconds; how far ahead a moving entity's swept bounds reach before they get refreshed
+
+
+class EntityCollider:
+	# predicts when this entity will touch other entities with EntityColliders, and schedules on_collide for both
+	def on_add(self, ent, world):
+		ent.pair_timers = {}
+		ent.pair_motion = None
+		ent.horizon_timer = world.time_provider.on_next(self.on_kinematic_update, ent)
+
+	def on_remove(self, ent, world):
+		for other, timer in ent.pair_timers.items():
+			timer.cancel()
+			del other.pair_timers[ent]
+		ent.pair_timers = {}
+		if ent.horizon_timer:
+			ent.horizon_timer.cancel()
+			ent.horizon_timer = None
+		ent.pair_motion = None
+		world.broadphase.remove(ent)
+
+	def on_kinematic_update(self, ent):
+		for other, timer in ent.pair_timers.items():
+			timer.cancel()
+			del other.pair_timers[ent]
+		ent.pair_timers = {}
+		if ent.horizon_timer:
+			ent.horizon_timer.cancel()
+			ent.horizon_timer = None
+		now = ent.now
+		w, h = ent.get_size()
+		x, y = ent.get_pos(now)
+		vx, vy = ent.get_velocity()
+		moving = vx != 0 or vy != 0
+		until = now + PAIR_HORIZON if moving else float("inf")
+		ent.pair_motion = x, y, vx, vy, now, until, w, h
+		# swept bounds over [now, until]
+		ex, ey = (x + vx * PAIR_HORIZON, y + vy * PAIR_HORIZON) if moving else (x, y)
+		bounds = min(x, ex) - w / 2, min(y, ey) - h / 2, max(x, ex) + w / 2, max(y, ey) + h / 2
+		grid = ent.world.broadphase
+		grid.update(ent, bounds)
+		for other in grid.query(bounds):
+			if other is not ent and other.pair_motion is not None:
+				self.predict(ent, other, now)
+		if moving:
+			ent.horizon_timer = ent.world.time_provider.add_timer_at(until, self.on_kinematic_update, ent)
+
+	def predict(self, ent, other, now):
+		x1, y1, vx1, vy1, t1, until1, w1, h1 = ent.pair_motion
+		x2, y2, vx2, vy2, t2, until2, w2, h2 = other.pair_motion
+		# relative motion of the other entity, starting now
+		px = x2 + vx2 * (now - t2) - x1 - vx1 * (now - t1)
+		py = y2 + vy2 * (now - t2) - y1 - vy1 * (now - t1)
+		vx, vy = vx2 - vx1, vy2 - vy1
+		half_w, half_h = (w1 + w2) / 2, (h1 + h2) / 2
+		time_x = EntityCollider._entry_time(px, vx, half_w)
+		time_y = EntityCollider._entry_time(py, vy, half_h)
+		# a contact along one axis only counts if the boxes overlap along the other axis at that moment, or are touching
+		# along it and closing in, so that entities which are merely touching can slide past each other but ones that
+		# meet corner to corner can't pass through each other.
+		best, horizontally, vertically = float("inf"), False, False
+		if time_x is not None and EntityCollider._overlaps(py + vy * time_x, vy, half_h):
+			best, horizontally = time_x, True
+		if time_y is not None and EntityCollider._overlaps(px + vx * time_y, vx, half_w):
+			if time_y < best:
+				best, horizontally, vertically = time_y, False, True
+			elif time_y == best:
+				vertically = True
+		if best <= min(until1, until2) - now:
+			timer = ent.world.time_provider.add_timer_at(now + best, self.on_contact, ent, other, horizontally, vertically)
+			ent.pair_timers[other] = timer
+			other.pair_timers[ent] = timer
+
+	@staticmethod
+	def _entry_time(position, velocity, half):
+		# when does the gap along this axis close, if it's closing at all? (within FUDGE_FACTOR counts as now)
+		if position > 0 and velocity < 0:
+			gap = position - half
+		elif position < 0 and velocity > 0:
+			gap = -position - half
+		else:
+			return None
+		if gap < -FUDGE_FACTOR:
+			return None  # already overlapping along this axis
+		return max(gap / abs(velocity), 0)
+
+	@staticmethod
+	def _overlaps(position, velocity, half):
+		if abs(position) < half - FUDGE_FACTOR:
+			return True
+		return abs(position) <= half + FUDGE_FACTOR and position * velocity < 0
+
+	def on_contact(self, ent, other, horizontally, vertically):
+		del ent.pair_timers[other]
+		del other.pair_timers[ent]
+		ent.on_collide(horizontally, vertically)
+		other.on_collide(horizontally, vertically)
 
 
 LAMBDA_TYPE = type(lambda: None)
@@ -172,6 +258,9 @@ class EntityType:
 		self.components = [component for component in components if type(component) != LAMBDA_TYPE]
 
 	def __call__(self, *args):
+		return Entity(*self.build_components(*args))
+
+	def build_components(self, *args):
 		if len(args) != self.arg_count:
 			raise TypeError("EntityType() missing %d required positional argument", self.arg_count)
 		components = self.components[:]
@@ -181,4 +270,4 @@ class EntityType:
 			components.append(lmb(*args[index:index+count]))
 			index += count
 		assert index == self.arg_count
-		return Entity(*components)
+		return components
@@ -0,0 +1,132 @@
+__author__ = 'colby'
+
+import entity
+
+try:
+	import numpy
+except ImportError:
+	numpy = None  # only the entity store needs it
+
+INITIAL_CAPACITY = 256
+X, Y, VX, VY, START_TIME = range(5)
+
+
+def available():
+	return numpy is not None
+
+
+class StoredEntity(entity.Entity):
+	# an Entity whose motion lives in an EntityStore. pos_vel_time is a view over its row there, so PositionVelocity,
+	# the colliders, and everything else that reads or writes it keep working as they are. it only takes up a row once
+	# it has some motion, and gives it back once it's removed from its world.
+	def __init__(self, store, *components):
+		entity.Entity.__init__(self, *components)
+		self.store = store
+		self.slot = None
+		on_remove = self.on_remove
+
+		def _on_remove(world):
+			out = on_remove(world)
+			store.remove(self)
+			return out
+		self.on_remove = _on_remove
+
+	@property
+	def pos_vel_time(self):
+		if self.slot is None:
+			raise AttributeError("pos_vel_time")
+		return tuple(self.store.motion[self.slot].tolist())
+
+	@pos_vel_time.setter
+	def pos_vel_time(self, value):
+		if self.slot is None:
+			self.store.add(self)
+		self.store.motion[self.slot] = value
+
+
+class EntityStore:
+	# keeps the motion of many entities in one numpy array, a row of (x, y, vx, vy, start time) per entity, so that
+	# all of their positions for a frame come out of one vectorized expression. entities drawn by nothing but a single
+	# RenderImage get drawn together, with one draw_quads per image; any others still get drawn one by one.
+	# see World.set_entity_store.
+	def __init__(self, capacity=INITIAL_CAPACITY):
+		if numpy is None:
+			raise ImportError("EntityStore needs numpy")
+		self.motion = numpy.zeros((capacity, 5))
+		self.kinds = numpy.zeros(capacity, numpy.int32)  # per row: index into self.images, or -1 to draw it by itself
+		self.entities = []  # per row
+		self.images = []  # RenderImage components
+		self.image_ids = {}  # (image, srcrect) -> index into self.images
+
+	def __len__(self):
+		return len(self.entities)
+
+	def create(self, entity_type, *args):
+		# like entity_type(*args), but stored here
+		return StoredEntity(self, entity_type.build_components(*args))
+
+	def draws(self, ent):
+		return getattr(ent, "store", None) is self and ent.slot is not None
+
+	def _kind(self, ent):
+		renderers = ent.renderers
+		if len(renderers) != 1 or getattr(renderers[0], "__func__", None) is not entity.RenderImage.render:
+			return -1
+		component = renderers[0].__self__
+		key = component.image, tuple(component.srcrect) if component.srcrect else None
+		kind = self.image_ids.get(key)
+		if kind is None:
+			kind = self.image_ids[key] = len(self.images)
+			self.images.append(component)
+		return kind
+
+	def add(self, ent):
+		slot = len(self.entities)
+		if slot == len(self.motion):
+			self.motion = numpy.concatenate((self.motion, numpy.zeros_like(self.motion)))
+			self.kinds = numpy.concatenate((self.kinds, numpy.zeros_like(self.kinds)))
+		self.entities.append(ent)
+		self.kinds[slot] = self._kind(ent)
+		ent.slot = slot
+
+	def remove(self, ent):
+		# the last row moves into the freed one, to keep the rows packed
+		slot = ent.slot
+		if slot is None:
+			return
+		last = self.entities.pop()
+		if last is not ent:
+			self.entities[slot] = last
+			self.motion[slot] = self.motion[len(self.entities)]
+			self.kinds[slot] = self.kinds[len(self.entities)]
+			last.slot = slot
+		ent.slot = None
+
+	def positions(self, now):
+		# the x and y of every row, as of now
+		motion = self.motion[:len(self.entities)]
+		elapsed = now - motion[:, START_TIME]
+		return motion[:, X] + motion[:, VX] * elapsed, motion[:, Y] + motion[:, VY] * elapsed
+
+	def render(self, renderer, rx, ry, now):
+		count = len(self.entities)
+		if not count:
+			return
+		xs, ys = self.positions(now)
+		xs += rx
+		ys += ry
+		ww, wh = renderer.get_size()
+		kinds = self.kinds[:count]
+		for kind, component in enumerate(self.images):
+			w, h = component.get_size(None)
+			shown = (kinds == kind) & (xs >= -w / 2) & (xs <= ww + w / 2) & (ys >= -h / 2) & (ys <= wh + h / 2)
+			x1, y1 = xs[shown] - w / 2, ys[shown] - h / 2
+			if len(x1):
+				x2, y2 = x1 + w, y1 + h
+				quads = numpy.stack((x1, y1, x2, y1, x2, y2, x1, y2), axis=1).astype(numpy.float32)
+				renderer.draw_quads(component.image, component.srcrect, quads, len(quads))
+		for slot in numpy.flatnonzero(kinds < 0).tolist():
+			ent = self.entities[slot]
+			w, h = ent.get_size() or (0, 0)
+			if -w / 2 <= xs[slot] <= ww + w / 2 and -h / 2 <= ys[slot] <= wh + h / 2:
+				ent.render(renderer, rx, ry, now)
@@ -0,0 +1,103 @@
+__author__ = 'colby'
+
+import collections
+import sdle
+
+
+class RecordedLayer:
+	def __init__(self, width, height):
+		self.size = width, height
+
+	def get_size(self):
+		return self.size
+
+	def destroy(self):
+		pass
+
+
+class RecordingWindow:
+	# stands in for sdle.Window when there's no display: nothing actually gets drawn, but every call gets counted
+	# (and optionally recorded, with its arguments), so the rendering code can be benchmarked and checked headlessly.
+	def __init__(self, width=640, height=480, record=False):
+		self.size = width, height
+		self.counts = collections.Counter()
+		self.calls = [] if record else None
+		self.layers = set()
+		self.batching = False
+		self.target = None
+
+	def _record(self, name, *args):
+		self.counts[name] += 1
+		if self.calls is not None:
+			self.calls.append((name, self.target) + args)
+
+	def reset(self):
+		self.counts.clear()
+		if self.calls is not None:
+			self.calls = []
+
+	def destroy(self):
+		self.layers = set()
+
+	def draw_line(self, x1, y1, x2, y2=None, color=None):
+		if y2 is None:
+			assert color is None
+			color = x2
+			x2, y2 = y1
+			x1, y1 = x1
+		else:
+			assert color is not None
+		self._record("draw_line", x1, y1, x2, y2, color)
+
+	def draw_image(self, name, srcrect=None, dstrect=None):
+		self._record("draw_image", name, sdle.round_rect(srcrect), sdle.round_rect(dstrect))
+
+	def draw_quads(self, name, srcrect, xy, count):
+		self._record("draw_quads", name, sdle.round_rect(srcrect), count)
+
+	def begin_batch(self):
+		self.batching = True
+
+	def end_batch(self):
+		self.batching = False
+
+	def create_layer(self, width, height):
+		layer = RecordedLayer(width, height)
+		self.layers.add(layer)
+		self._record("create_layer", width, height)
+		return layer
+
+	def destroy_layer(self, layer):
+		self.layers.remove(layer)
+		self._record("destroy_layer", layer)
+
+	def begin_layer(self, layer):
+		assert layer in self.layers
+		self.target = layer
+
+	def end_layer(self):
+		self.target = None
+
+	def draw_layer(self, layer, x, y):
+		assert layer in self.layers
+		self._record("draw_layer", layer, round(x), round(y))
+
+	def clear_rect(self, rect):
+		self._record("clear_rect", sdle.round_rect(rect))
+
+	def draw_image_centered(self, name, srcrect=None, cx=None, cy=None):
+		assert cx is not None
+		w, h = srcrect[2:4] if srcrect else sdle.get_image_size(name)
+		if cy is None:
+			cx, cy = cx
+		self.draw_image(name, srcrect, (cx - w / 2, cy - h / 2, w, h))
+		return w, h
+
+	def clear(self):
+		self._record("clear")
+
+	def present(self):
+		self._record("present")
+
+	def get_size(self):
+		return self.size
@@ -1,41 +1,182 @@
 __author__ = 'skeggsc'
 
+import array
+import mmap
+import os
+import struct
+import sys
+import tile
 import world
 
+# compiled maps: a header, the solid icons, a symbol table, the stateful cells, and then the packed cell array, which
+# already holds the icon ids that World uses (0 is None, and symbol n is n + 1), so it can be used straight from mmap.
+MAGIC = b"TKLM"
+VERSION = 1
+HEADER = struct.Struct("<4sHBxIIHHI")  # magic, version, big-endian cells?, width, height, symbols, solids, stateful
+ICON = struct.Struct("<ii")
+STATEFUL = struct.Struct("<IH")  # cell index, symbol id
+COMPILED_SUFFIX = ".mapc"
 
-def load(filename, tileset, time_provider):
+
+def _resolve(ref, refs):
+    if ref not in refs:
+        base, attr = ref.split(".")
+        refs[ref] = getattr(__import__(base), attr)
+    return refs[ref]
+
+
+def _instantiate(constructor, args):
+    # TileTypes go into the world as flyweights, and only become real Tiles when used
+    if isinstance(constructor, tile.TileType) and not args:
+        return constructor
+    return constructor(*args)
+
+
+def _parse_header(f):
+    # reads up to and including the "%%" line, and returns (symbols, solid)
+    types = {}
+    solid = []
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        if line == "%%":
+            break
+        symbol, ref, *args = line.split(" ")
+        if symbol == "solid":
+            solid += [tuple(int(k) for k in x.split(",")) for x in [ref] + args]
+            assert all(len(x) == 2 for x in solid)
+            continue
+        assert len(symbol) == 1, "for now, symbols must be one character long"
+        assert symbol not in types, "multiple definitions for symbol: '%s'" % symbol
+        pargs = [int(arg) if arg.isdigit() else arg for arg in args]
+        types[symbol] = (ref, pargs)
+    else:
+        raise Exception("Did not find proper end of map!")
+    assert solid
+    return types, solid
+
+
+def parse(filename):
+    # returns (symbols, solid, rows), where symbols maps each symbol to (ref, args)
     with open(filename, "r") as f:
-        refs = {}
-        types = {}
-        solid = []
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            if line == "%%":
-                break
-            symbol, ref, *args = line.split(" ")
-            if symbol == "solid":
-                solid += [tuple(int(k) for k in x.split(",")) for x in [ref] + args]
-                assert all(len(x) == 2 for x in solid)
-                continue
-            assert len(symbol) == 1, "for now, symbols must be one character long"
-            assert symbol not in types, "multiple definitions for symbol: '%s'" % symbol
-            if ref not in refs:
-                base, attr = ref.split(".")
-                refs[ref] = getattr(__import__(base), attr)
-            pargs = [int(arg) if arg.isdigit() else arg for arg in args]
-            types[symbol] = (refs[ref], pargs)
-        else:
-            raise Exception("Did not find proper end of map!")
-        assert solid
+        types, solid = _parse_header(f)
         # map body
         rows = []
         for row in f:
             row = row.strip('\n')
             if rows:
                 assert len(rows[0]) == len(row), "mismatched row lengths"
-            rows.append([types[c][0](*types[c][1]) for c in row])
+            rows.append(row)
         assert rows, "map cannot be empty!"
-        columns = tuple(zip(*rows))
-    return world.World(columns, tileset, solid, time_provider)
+    return types, solid, rows
+
+
+def map_types(filename):
+    # everything that the map's symbols refer to, such as tile types. only needs the header, not the map body.
+    with open(filename, "r") as f:
+        types, solid = _parse_header(f)
+    refs = {}
+    return [_resolve(ref, refs) for ref, args in types.values()]
+
+
+def load_text(filename, tileset, time_provider, ray_caster=None):
+    types, solid, rows = parse(filename)
+    refs = {}
+    types = dict((symbol, (_resolve(ref, refs), args)) for symbol, (ref, args) in types.items())
+    columns = tuple(zip(*[[_instantiate(*types[c]) for c in row] for row in rows]))
+    return world.World(columns, tileset, solid, time_provider, ray_caster)
+
+
+def compile_map(filename):
+    types, solid, rows = parse(filename)
+    refs = {}
+    symbols = sorted(types)
+    ids = dict((symbol, i + 1) for i, symbol in enumerate(symbols))
+    table = []
+    stateful_ids = set()
+    for symbol in symbols:
+        ref, args = types[symbol]
+        # stateless symbols get evaluated once, right now; stateful ones get instantiated per cell when loading
+        value = _resolve(ref, refs)(*args)
+        if isinstance(value, tile.Tile):
+            encoded = " ".join([ref] + [str(arg) for arg in args]).encode()
+            table.append(struct.pack("<BH", 1, len(encoded)) + encoded)
+            stateful_ids.add(ids[symbol])
+        else:
+            assert type(value) == tuple and len(value) == 2, "icons must be pairs of ints"
+            table.append(struct.pack("<B", 0) + ICON.pack(*value))
+    width, height = len(rows[0]), len(rows)
+    cells = array.array("H", [ids[rows[y][x]] for x in range(width) for y in range(height)])
+    stateful = [STATEFUL.pack(index, cell) for index, cell in enumerate(cells) if cell in stateful_ids]
+    out = [HEADER.pack(MAGIC, VERSION, sys.byteorder == "big", width, height, len(symbols), len(solid), len(stateful))]
+    out += [ICON.pack(*icon) for icon in solid]
+    out += table
+    out += stateful
+    if sum(len(part) for part in out) % 2:
+        out.append(b"\0")  # keep the cell array aligned
+    out.append(cells.tobytes())
+    return b"".join(out)
+
+
+def load_compiled(data, tileset, time_provider, ray_caster=None):
+    magic, version, big_endian, width, height, symbol_count, solid_count, stateful_count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or big_endian != (sys.byteorder == "big"):
+        raise ValueError("incompatible compiled map")
+    offset = HEADER.size
+    solid = []
+    for i in range(solid_count):
+        solid.append(ICON.unpack_from(data, offset))
+        offset += ICON.size
+    icons = [None]
+    stateful_types = {}
+    refs = {}
+    for i in range(symbol_count):
+        kind = data[offset]
+        if kind == 0:
+            icons.append(ICON.unpack_from(data, offset + 1))
+            offset += 1 + ICON.size
+        else:
+            length, = struct.unpack_from("<H", data, offset + 1)
+            ref, *args = bytes(data[offset + 3:offset + 3 + length]).decode().split(" ")
+            stateful_types[i + 1] = (_resolve(ref, refs), [int(arg) if arg.isdigit() else arg for arg in args])
+            icons.append(None)
+            offset += 3 + length
+    stateful = [STATEFUL.unpack_from(data, offset + i * STATEFUL.size) for i in range(stateful_count)]
+    offset += stateful_count * STATEFUL.size
+    offset += offset % 2
+    if len(data) < offset + 2 * width * height:
+        raise ValueError("truncated compiled map")
+    cells = memoryview(data)[offset:offset + 2 * width * height].cast("H")
+    out = world.World.from_cells(width, height, icons, cells, tileset, solid, time_provider, ray_caster)
+    for index, symbol_id in stateful:
+        out[index // height, index % height] = _instantiate(*stateful_types[symbol_id])
+    return out
+
+
+def compiled_path(filename):
+    return os.path.splitext(filename)[0] + COMPILED_SUFFIX
+
+
+def load(filename, tileset, time_provider, ray_caster=None):
+    # uses the compiled version of the map when it's newer than the text, and (re)compiles it otherwise
+    path = compiled_path(filename)
+    try:
+        fresh = os.path.getmtime(path) >= os.path.getmtime(filename)
+    except OSError:
+        fresh = False
+    if fresh:
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            return load_compiled(data, tileset, time_provider, ray_caster)
+        except (OSError, ValueError, struct.error, IndexError, ImportError, AttributeError):
+            pass  # empty, truncated, from an older version, or naming something that's gone: compile it again
+    data = compile_map(filename)
+    try:
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass  # not being able to cache it is fine
+    return load_compiled(bytearray(data), tileset, time_provider, ray_caster)
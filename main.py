@@ -2,27 +2,48 @@ __author__ = 'colby'
 # depends on pysdl2-cffi
 # Interesting technical part of this: this game is tickless!
 
+import asyncio
 import sdle
 import sdl
+import stats
+import sys
+import time
 import world
 import tile
 
 import door
 import player
 import loader
+import preload
 
 
 class MainLoop:
 	running = True
 	direction_keycodes = (sdl.SCANCODE_W, sdl.SCANCODE_A, sdl.SCANCODE_S, sdl.SCANCODE_D)
 
-	def __init__(self):
+	frame_phases = [("loop.pump", (255, 255, 0)), ("frame.clear", (128, 128, 255)), ("frame.world", (0, 255, 0)),
+					("frame.gui", (255, 0, 255)), ("frame.present", (255, 0, 0))]
+
+	def __init__(self, idle=False, max_fps=None, vsync=False, stats=None, overlay=False, use_asyncio=False):
 		self.win_size = 640, 480
-		self.window = sdle.Window("Tickless", self.win_size[0], self.win_size[1])
+		# in idle mode, we only render when something changed, and otherwise sleep until the next timer or input
+		self.idle = idle
+		self.max_fps = max_fps
+		# get the images decoding before anything needs them
+		sdle.preload_images(preload.manifest(["tileset2.png", player.Player] + loader.map_types("map.txt")))
+		self.window = sdle.Window("Tickless", self.win_size[0], self.win_size[1], vsync)
 		self.tileset = world.Tileset("tileset2.png", 4, 4)
-		self.event_loop = sdle.EventLoop(
-			on_quit=self.on_quit, on_mouse_down=self.on_click, on_key_down=self.on_key_down, on_key_up=self.on_key_up)
+		events = dict(on_quit=self.on_quit, on_mouse_down=self.on_click, on_key_down=self.on_key_down, on_key_up=self.on_key_up)
+		if use_asyncio:
+			# asyncio runs the timers, so that the game can share the process with asyncio networking and so on
+			self.aio = asyncio.new_event_loop()
+			asyncio.set_event_loop(self.aio)
+			self.event_loop = sdle.AsyncEventLoop(self.aio, **events)
+		else:
+			self.aio = None
+			self.event_loop = sdle.EventLoop(**events)
 		self.world = loader.load("map.txt", self.tileset, self.event_loop)
+		self.world.build_pathfinder()  # while loading, instead of on the first click to move
 		# world.World(19, 14, self.tileset, (0, 0), [(0, 0), (2, 0)], self.event_loop)
 		self.directions = [False, False, False, False]
 
@@ -32,6 +53,11 @@ class MainLoop:
 
 		self.generate_world()
 
+		self.stats = None
+		self.overlay = None
+		if stats is not None:
+			self.instrument(stats, overlay)
+
 	def on_quit(self):
 		self.running = False
 
@@ -48,7 +74,7 @@ class MainLoop:
 		else:
 			vx, vy = self.get_viewport_position()
 			cx, cy, rx, ry = self.world.unmap(x - vx, y - vy)
-			if cx and self.player is not None:
+			if cx is not None and self.player is not None:
 				self.player.control_click(cx, cy, rx, ry)
 
 	def on_key_down(self, win, sym, scancode, mod, repeat):
@@ -62,7 +88,15 @@ class MainLoop:
 			self.update_motion()
 
 	def get_viewport_position(self):
-		return 0, 0
+		# keep the player in the middle of the screen, without scrolling past the edges of the map
+		if self.player is None:
+			return 0, 0
+		px, py = self.player.get_pos(self.event_loop.now())
+		cw, ch = self.tileset.cell_size()
+		map_w, map_h = self.world.width * cw, self.world.height * ch
+		vx = min(0, max(self.win_size[0] - map_w, self.win_size[0] / 2 - px))
+		vy = min(0, max(self.win_size[1] - map_h, self.win_size[1] / 2 - py))
+		return round(vx), round(vy)
 
 	def update_motion(self):
 		if self.player is not None:
@@ -82,24 +116,106 @@ class MainLoop:
 	def open_gui(self, gui):
 		self.gui = gui
 
+	def render(self):
+		self.window.clear()
+		vx, vy = self.get_viewport_position()
+		self.world.render(self.window, vx, vy)
+		if self.gui is not None:
+			self.gui_size = self.gui.render(self.window, self.win_size[0] / 2, self.win_size[1] / 2)
+		else:
+			self.gui_size = 0, 0
+		self.window.present()
+
+	def instrument(self, frame_stats, overlay=False):
+		# records timings into frame_stats by swapping in instrumented methods, so that nothing changes when it's off
+		self.stats = frame_stats
+		self.event_loop.instrument(frame_stats)
+		frame_stats.timed(self.world, "recalculate_cache", "world.recalculate_cache")
+		self.render = self._render_instrumented
+		if overlay:
+			self.overlay = stats.Overlay(frame_stats, self.frame_phases)
+
+	def _render_instrumented(self):
+		frame_stats = self.stats
+		start = time.perf_counter()
+		self.window.clear()
+		cleared = time.perf_counter()
+		vx, vy = self.get_viewport_position()
+		self.world.render(self.window, vx, vy)
+		rendered = time.perf_counter()
+		if self.gui is not None:
+			self.gui_size = self.gui.render(self.window, self.win_size[0] / 2, self.win_size[1] / 2)
+		else:
+			self.gui_size = 0, 0
+		gui_done = time.perf_counter()
+		if self.overlay is not None:
+			self.overlay.render(self.window, 8, self.win_size[1] - 8)
+		presenting = time.perf_counter()
+		self.window.present()
+		frame_stats.add("frame.clear", cleared - start)
+		frame_stats.add("frame.world", rendered - cleared)
+		frame_stats.add("frame.gui", gui_done - rendered)
+		frame_stats.add("frame.present", time.perf_counter() - presenting)
+
 	def mainloop(self):
+		if self.aio is not None:
+			return self.aio.run_until_complete(self.async_mainloop())
+		if self.idle:
+			return self.idle_mainloop()
 		while self.running:
 			# LOOP FOREVER AS FAST AS POSSIBLE
 			# Unlimited FPS ftw?
 			self.event_loop.pump()
-			self.window.clear()
-			vx, vy = self.get_viewport_position()
-			self.world.render(self.window, vx, vy)
-			if self.gui is not None:
-				self.gui_size = self.gui.render(self.window, self.win_size[0] / 2, self.win_size[1] / 2)
-			else:
-				self.gui_size = 0, 0
-			self.window.present()
+			self.render()
+
+	def idle_mainloop(self):
+		frame_time = 1.0 / self.max_fps if self.max_fps else 0
+		last_frame = float("-inf")
+		redraw = True
+		while self.running:
+			if self.event_loop.pump():
+				redraw = True
+			animating = self.world.is_animating()
+			now = time.monotonic()
+			if (redraw or animating) and now >= last_frame + frame_time:
+				self.render()
+				last_frame = now
+				redraw = False
+			# the only things that can change what's on screen are timers, input, and moving entities
+			wake = self.event_loop.next_deadline()
+			if redraw or animating:
+				wake = min(wake, last_frame + frame_time)
+			self.event_loop.wait_until(wake)
+
+	async def async_mainloop(self):
+		# input gets pumped by a task of its own, and this one renders, while asyncio runs the timers in between
+		frame_time = 1.0 / self.max_fps if self.max_fps else 0
+		loop = self.event_loop
+		pumping = asyncio.ensure_future(loop.pump_forever())
+		try:
+			while self.running:
+				if self.idle and not self.world.is_animating():
+					await loop.activity.wait()
+				loop.activity.clear()
+				start = time.monotonic()
+				self.render()
+				await asyncio.sleep(max(0.0, start + frame_time - time.monotonic()))
+		finally:
+			pumping.cancel()
 
 	def destroy(self):
 		self.window.destroy()
+		sdle.release_images()
+		if self.aio is not None:
+			self.aio.close()
 
 if __name__ == "__main__":
-	ml = MainLoop()
+	# --stats prints timing histograms on exit, and --overlay also graphs the frame times on screen. --asyncio runs
+	# everything on an asyncio event loop.
+	overlay = "--overlay" in sys.argv
+	ml = MainLoop(idle=True, vsync=True, stats=stats.Stats() if overlay or "--stats" in sys.argv else None, overlay=overlay,
+		use_asyncio="--asyncio" in sys.argv)
 	ml.mainloop()
+	if ml.stats is not None:
+		print(ml.stats.report())
 	ml.destroy()
@@ -0,0 +1,380 @@
+__author__ = 'colby'
+
+import array
+import socket
+import struct
+import sys
+
+import world
+
+# entity motion is piecewise linear, so the server only ever has to send the pos_vel_time records of entities whose
+# velocity actually changed, plus the cells whose icons changed; clients extrapolate everything else themselves.
+# every message is a FRAME header followed by its payload.
+FRAME = struct.Struct("<BI")  # message type, payload length
+MSG_MAP, MSG_TILE, MSG_SPAWN, MSG_MOVE, MSG_REMOVE, MSG_PING, MSG_PONG, MSG_ECHO, MSG_SYNC = range(9)
+MAP = struct.Struct("<dIII")  # server clock, width, height, icon count; followed by the icons and then the cells
+ICON = struct.Struct("<Bii")  # whether there's an icon, and its x and y in the tileset
+TILE = struct.Struct("<II")  # cell x, y; followed by an ICON
+KINEMATIC = struct.Struct("<Iffffd")  # entity id, pos_vel_time; SPAWN is followed by the kind's name
+REMOVE = struct.Struct("<I")
+# clock syncs: the client sends an empty PING, the server answers with a PONG, which the client sends right back as
+# an ECHO, and the server reports the result in a SYNC. the PONG and the ECHO are what get timed, and whoever is
+# waiting for one of them checks for it every SYNC_POLL_INTERVAL, so that neither side's POLL_INTERVAL skews the timing.
+PONG = struct.Struct("<d")  # server clock
+ECHO = struct.Struct("<dd")  # server clock from the pong, client clock when it arrived
+SYNC = struct.Struct("<ddd")  # the echo, then the server clock when it arrived
+
+POLL_INTERVAL = 0.02  # seconds between checks for network traffic
+SYNC_INTERVAL = 1.0  # seconds between clock pings
+SYNC_POLL_INTERVAL = 0.001  # seconds between checks for network traffic, while waiting on a PONG or an ECHO
+SYNC_TIMEOUT = 1.0  # seconds to wait on a PONG or an ECHO before giving up on it
+SYNC_SAMPLES = 8  # pings to remember; the one with the shortest round trip wins
+TOLERANCE = 1e-3  # pixels that an extrapolated position can be off by and still count as unchanged
+
+
+def _frame(kind, payload):
+	return FRAME.pack(kind, len(payload)) + payload
+
+
+def _pack_icon(icon):
+	return ICON.pack(0, 0, 0) if icon is None else ICON.pack(1, *icon)
+
+
+def _unpack_icon(data, offset):
+	present, x, y = ICON.unpack_from(data, offset)
+	return (x, y) if present else None
+
+
+def _record(ent):
+	# what a client needs to extrapolate the entity, in server time
+	pos_vel_time = getattr(ent, "pos_vel_time", None)
+	if pos_vel_time is not None:
+		return pos_vel_time
+	now = ent.now
+	return ent.get_pos(now) + ent.get_velocity() + (now,)
+
+
+def _same_motion(old, new):
+	ox, oy, ovx, ovy, ot = old
+	nx, ny, nvx, nvy, nt = new
+	return ovx == nvx and ovy == nvy and abs(ox + ovx * (nt - ot) - nx) < TOLERANCE and abs(oy + ovy * (nt - ot) - ny) < TOLERANCE
+
+
+class _Connection:
+	# a nonblocking socket, with buffering in both directions
+	def __init__(self, sock):
+		sock.setblocking(False)
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.sock = sock
+		self.inbox = bytearray()
+		self.outbox = bytearray()
+		self.closed = False
+
+	def send(self, data):
+		self.outbox += data
+		self.flush()
+
+	def flush(self):
+		while self.outbox and not self.closed:
+			try:
+				sent = self.sock.send(self.outbox)
+			except (BlockingIOError, InterruptedError):
+				return
+			except OSError:
+				self.close()
+				return
+			del self.outbox[:sent]
+
+	def receive(self):
+		# returns the complete messages that have arrived, as (type, payload)
+		while not self.closed:
+			try:
+				data = self.sock.recv(65536)
+			except (BlockingIOError, InterruptedError):
+				break
+			except OSError:
+				data = b""
+			if not data:
+				self.close()
+				break
+			self.inbox += data
+		out = []
+		offset = 0
+		while len(self.inbox) - offset >= FRAME.size:
+			kind, length = FRAME.unpack_from(self.inbox, offset)
+			if len(self.inbox) - offset - FRAME.size < length:
+				break
+			start = offset + FRAME.size
+			out.append((kind, bytes(self.inbox[start:start + length])))
+			offset = start + length
+		del self.inbox[:offset]
+		return out
+
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			self.sock.close()
+
+
+class ReplicationServer:
+	# serves a World to clients over TCP. entities only get replicated once they're tracked, under the name of their
+	# kind, which clients use to pick out how to draw them. changes get collected while timers run and sent out
+	# together right after, so the traffic (and the work) grows with the number of velocity changes, not with the
+	# number of entities or the frame rate.
+	def __init__(self, world, host="127.0.0.1", port=0, poll_interval=POLL_INTERVAL):
+		self.world = world
+		self.loop = world.time_provider
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind((host, port))
+		self.listener.listen()
+		self.listener.setblocking(False)
+		self.address = self.listener.getsockname()
+		self.clients = []
+		self.next_id = 0
+		self.tracked = {}  # entity -> [entity id, kind, last sent record, original on_kinematic_update]
+		self.moved = set()
+		self.changed_cells = set()
+		self.flush_timer = None
+		self.waiting = {}  # client -> timer that checks it for the echo of a pong
+		self.bytes_sent = 0
+		# shadow World._set_icon, which every change to a cell's icon goes through
+		set_icon = world._set_icon
+
+		def _set_icon(x, y, icon):
+			set_icon(x, y, icon)
+			self.changed_cells.add((x, y))
+			self._schedule()
+		world._set_icon = _set_icon
+		self.poll_timer = self.loop.add_interval(poll_interval, self.poll)
+
+	def track(self, ent, kind):
+		eid = self.next_id
+		self.next_id += 1
+		record = _record(ent)
+		on_kinematic_update = ent.on_kinematic_update
+		self.tracked[ent] = [eid, kind, record, on_kinematic_update]
+
+		def _on_kinematic_update(*args):
+			out = on_kinematic_update(*args)
+			self.moved.add(ent)
+			self._schedule()
+			return out
+		ent.on_kinematic_update = _on_kinematic_update
+		self._broadcast(self._spawn(eid, kind, record))
+		return eid
+
+	def untrack(self, ent):
+		eid, _, _, ent.on_kinematic_update = self.tracked.pop(ent)
+		self.moved.discard(ent)
+		self._broadcast(_frame(MSG_REMOVE, REMOVE.pack(eid)))
+
+	def _spawn(self, eid, kind, record):
+		return _frame(MSG_SPAWN, KINEMATIC.pack(eid, *record) + kind.encode())
+
+	def _schedule(self):
+		if self.flush_timer is None:
+			self.flush_timer = self.loop.on_next(self.flush)
+
+	def _broadcast(self, data):
+		for client in self.clients:
+			client.send(data)
+		self.bytes_sent += len(data) * len(self.clients)
+
+	def flush(self):
+		self.flush_timer = None
+		parts = []
+		for ent in self.moved:
+			entry = self.tracked[ent]
+			record = _record(ent)
+			# things like map updates set the same velocity again, which doesn't change anything for the clients
+			if not _same_motion(entry[2], record):
+				entry[2] = record
+				parts.append(_frame(MSG_MOVE, KINEMATIC.pack(entry[0], *record)))
+		self.moved.clear()
+		for x, y in self.changed_cells:
+			parts.append(_frame(MSG_TILE, TILE.pack(x, y) + _pack_icon(self.world.get_icon_only(x, y))))
+		self.changed_cells.clear()
+		if parts:
+			self._broadcast(b"".join(parts))
+
+	def _snapshot(self):
+		w = self.world
+		cells = array.array("H", w.cells)
+		if sys.byteorder == "big":
+			cells.byteswap()
+		parts = [MAP.pack(self.loop.clock(), w.width, w.height, len(w.icons))]
+		parts += [_pack_icon(icon) for icon in w.icons]
+		parts.append(cells.tobytes())
+		out = [_frame(MSG_MAP, b"".join(parts))]
+		out += [self._spawn(eid, kind, record) for eid, kind, record, _ in self.tracked.values()]
+		return b"".join(out)
+
+	def poll(self):
+		while True:
+			try:
+				sock, _ = self.listener.accept()
+			except (BlockingIOError, InterruptedError):
+				break
+			client = _Connection(sock)
+			self.clients.append(client)
+			snapshot = self._snapshot()
+			client.send(snapshot)
+			self.bytes_sent += len(snapshot)
+		for client in self.clients:
+			self._receive(client)
+			if client.closed:
+				self._wait(client, False)
+		self.clients = [client for client in self.clients if not client.closed]
+
+	def _receive(self, client):
+		for kind, payload in client.receive():
+			if kind == MSG_PING:
+				client.send(_frame(MSG_PONG, PONG.pack(self.loop.clock())))
+				self._wait(client, True)
+			elif kind == MSG_ECHO:
+				sent, received = ECHO.unpack(payload)
+				client.send(_frame(MSG_SYNC, SYNC.pack(sent, received, self.loop.clock())))
+				self._wait(client, False)
+		client.flush()
+
+	def _wait(self, client, waiting):
+		timer = self.waiting.pop(client, None)
+		if timer is not None:
+			timer.cancel()
+		if waiting:
+			self.waiting[client] = self.loop.add_interval(SYNC_POLL_INTERVAL, self._await, client, self.loop.clock() + SYNC_TIMEOUT)
+
+	def _await(self, client, deadline):
+		if client.closed or self.loop.clock() > deadline:
+			self._wait(client, False)
+		else:
+			self._receive(client)
+
+	def close(self):
+		self.poll_timer.cancel()
+		if self.flush_timer is not None:
+			self.flush_timer.cancel()
+		for client in list(self.waiting):
+			self._wait(client, False)
+		for ent in list(self.tracked):
+			self.untrack(ent)
+		del self.world._set_icon
+		for client in self.clients:
+			client.close()
+		self.clients = []
+		self.listener.close()
+
+
+class RemoteEntity:
+	# the client's copy of a replicated entity: just enough for its kind's renderers to draw it
+	def __init__(self, kind, pos_vel_time):
+		self.kind = kind
+		self.pos_vel_time = pos_vel_time
+
+	def get_pos(self, now):
+		x, y, vx, vy, start_time = self.pos_vel_time
+		return x + vx * (now - start_time), y + vy * (now - start_time)
+
+
+class ReplicationClient:
+	# mirrors a ReplicationServer's World. prototypes maps kind names to entities that draw that kind (their renderers
+	# are all that gets used), and the world shows up once the server's snapshot does. records are in server time, so
+	# the client keeps an estimate of the offset between the clocks, from the fastest of its recent pings.
+	def __init__(self, loop, tileset, prototypes, host, port, poll_interval=POLL_INTERVAL, sync_interval=SYNC_INTERVAL):
+		self.loop = loop
+		self.tileset = tileset
+		self.prototypes = prototypes
+		self.world = None
+		self.entities = {}  # entity id -> RemoteEntity
+		self.samples = []  # (round trip, offset)
+		self.offset = None
+		self.waiting = None  # timer that checks for the pong of a ping
+		self.connection = _Connection(socket.create_connection((host, port)))
+		self.sync()
+		self.poll_timer = loop.add_interval(poll_interval, self.poll)
+		self.sync_timer = loop.add_interval(sync_interval, self.sync)
+
+	def server_now(self):
+		return self.loop.clock() + (self.offset or 0)
+
+	def sync(self):
+		self.connection.send(_frame(MSG_PING, b""))
+		self._wait(True)
+
+	def _wait(self, waiting):
+		if self.waiting is not None:
+			self.waiting.cancel()
+			self.waiting = None
+		if waiting:
+			self.waiting = self.loop.add_interval(SYNC_POLL_INTERVAL, self._await, self.loop.clock() + SYNC_TIMEOUT)
+
+	def _await(self, deadline):
+		if self.connection.closed or self.loop.clock() > deadline:
+			self._wait(False)
+		else:
+			self.poll()
+
+	def _on_sync(self, sent, received, echoed):
+		# both ends timed the pong and its echo as they arrived, so the pong took half of the server's round trip
+		round_trip = echoed - sent
+		self.samples = self.samples[-(SYNC_SAMPLES - 1):] + [(round_trip, sent + round_trip / 2 - received)]
+		self.offset = min(self.samples)[1]
+
+	def _on_map(self, payload):
+		server_clock, width, height, icon_count = MAP.unpack_from(payload, 0)
+		offset = MAP.size
+		icons = []
+		for _ in range(icon_count):
+			icons.append(_unpack_icon(payload, offset))
+			offset += ICON.size
+		cells = array.array("H")
+		cells.frombytes(payload[offset:offset + 2 * width * height])
+		if sys.byteorder == "big":
+			cells.byteswap()
+		if self.offset is None:
+			self.offset = server_clock - self.loop.clock()  # only until the first pong
+		self.world = world.World.from_cells(width, height, icons, cells, self.tileset, (), self.loop)
+
+	def poll(self):
+		for kind, payload in self.connection.receive():
+			if kind == MSG_MOVE:
+				eid, x, y, vx, vy, start_time = KINEMATIC.unpack(payload)
+				entity = self.entities.get(eid)
+				if entity is not None:
+					entity.pos_vel_time = x, y, vx, vy, start_time
+			elif kind == MSG_TILE:
+				x, y = TILE.unpack_from(payload, 0)
+				if self.world is not None:
+					self.world.update_icon_only(x, y, _unpack_icon(payload, TILE.size))
+			elif kind == MSG_SPAWN:
+				eid, x, y, vx, vy, start_time = KINEMATIC.unpack_from(payload, 0)
+				self.entities[eid] = RemoteEntity(payload[KINEMATIC.size:].decode(), (x, y, vx, vy, start_time))
+			elif kind == MSG_REMOVE:
+				self.entities.pop(REMOVE.unpack(payload)[0], None)
+			elif kind == MSG_PONG:
+				self.connection.send(_frame(MSG_ECHO, ECHO.pack(PONG.unpack(payload)[0], self.loop.clock())))
+				self._wait(False)
+			elif kind == MSG_SYNC:
+				self._on_sync(*SYNC.unpack(payload))
+			elif kind == MSG_MAP:
+				self._on_map(payload)
+		self.connection.flush()
+
+	def render(self, renderer, rx, ry):
+		if self.world is None:
+			return
+		now = self.server_now()
+		renderer.begin_batch()
+		self.world.render_tiles(renderer, rx, ry)
+		for entity in self.entities.values():
+			for render in self.prototypes[entity.kind].renderers:
+				if render(renderer, entity, rx, ry, now):
+					break
+		renderer.end_batch()
+
+	def close(self):
+		self.poll_timer.cancel()
+		self.sync_timer.cancel()
+		self._wait(False)
+		self.connection.close()
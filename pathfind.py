@@ -0,0 +1,306 @@
+__author__ = 'colby'
+
+import collections
+import heapq
+import itertools
+import math
+
+CLUSTER_CELLS = 16  # width of a cluster of the abstract graph, in map cells
+LONG_ENTRANCE = 6  # entrances at least this wide get a transition at each end, instead of one in the middle
+ARRIVAL_TOLERANCE = 0.5  # pixels from a waypoint that count as being there
+_STEPS = ((0, -1), (0, 1), (-1, 0), (1, 0))
+
+
+def _corners(cells):
+	# just the cells where the path turns, plus both ends
+	out = cells[:2]
+	for before, previous, cell in zip(cells, cells[1:], cells[2:]):
+		if (cell[0] - previous[0], cell[1] - previous[1]) == (previous[0] - before[0], previous[1] - before[1]):
+			out[-1] = cell
+		else:
+			out.append(cell)
+	return out
+
+
+class Pathfinder:
+	# hierarchical pathfinding over a World's solidity bitmaps. the map gets split into square clusters; transitions
+	# get placed along the open stretches of the borders between them, and the shortest paths between the
+	# transitions of each cluster get precomputed, so that a query only searches the (small) graph of transitions
+	# plus the clusters at either end. a change to a cell only invalidates its own cluster, and the neighbors that
+	# share a border with it if the transitions along that border moved. paths are 4-connected, and close to (but not
+	# always exactly) the shortest.
+	def __init__(self, world, cluster_cells=CLUSTER_CELLS):
+		self.world = world
+		self.size = cluster_cells
+		self.columns = -(-world.width // cluster_cells)
+		self.rows = -(-world.height // cluster_cells)
+		self.solidity = {}  # cluster -> the solid bits of its cells, as of when it was last built
+		self.borders = {}  # (cluster x, cluster y, 0 for the right border or 1 for the bottom) -> transition pairs
+		self.links = collections.defaultdict(list)  # transition -> the transitions across borders from it
+		self.edges = {}  # cluster -> {transition: [(transition, cost)]}
+		self.dirty = set(itertools.product(range(self.columns), range(self.rows)))
+
+	def invalidate(self, x=None, y=None):
+		if x is None:
+			self.dirty.update(itertools.product(range(self.columns), range(self.rows)))
+		else:
+			self.dirty.add((x // self.size, y // self.size))
+
+	def _cluster(self, cell):
+		return cell[0] // self.size, cell[1] // self.size
+
+	def _bounds(self, cluster):
+		cx, cy = cluster
+		return cx * self.size, cy * self.size, min((cx + 1) * self.size, self.world.width), min((cy + 1) * self.size, self.world.height)
+
+	def _open(self, x, y):
+		return not self.world.solid_columns[x] >> y & 1
+
+	def _snapshot(self, cluster):
+		x1, y1, x2, y2 = self._bounds(cluster)
+		mask = (1 << y2) - (1 << y1)
+		return tuple(self.world.solid_columns[x] & mask for x in range(x1, x2))
+
+	def _transitions(self, key):
+		# the transition pairs along one border, from the runs of cells that are open on both sides
+		cx, cy, axis = key
+		x1, y1, x2, y2 = self._bounds((cx, cy))
+		if axis == 0:
+			pairs = [((x2 - 1, i), (x2, i)) for i in range(y1, y2)]
+		else:
+			pairs = [((i, y2 - 1), (i, y2)) for i in range(x1, x2)]
+		out = []
+		run = []
+		for pair in pairs + [None]:
+			if pair is not None and self._open(*pair[0]) and self._open(*pair[1]):
+				run.append(pair)
+				continue
+			if len(run) >= LONG_ENTRANCE:
+				out += [run[0], run[-1]]
+			elif run:
+				out.append(run[len(run) // 2])
+			run = []
+		return out
+
+	def _border_keys(self, cluster):
+		cx, cy = cluster
+		keys = []
+		if cx > 0:
+			keys.append((cx - 1, cy, 0))
+		if cx < self.columns - 1:
+			keys.append((cx, cy, 0))
+		if cy > 0:
+			keys.append((cx, cy - 1, 1))
+		if cy < self.rows - 1:
+			keys.append((cx, cy, 1))
+		return keys
+
+	def refresh(self):
+		# rebuilds the parts of the graph that changed since last time (all of it, the first time)
+		if not self.dirty:
+			return
+		changed = set()
+		for cluster in self.dirty:
+			snapshot = self._snapshot(cluster)
+			if self.solidity.get(cluster) != snapshot:
+				self.solidity[cluster] = snapshot
+				changed.add(cluster)
+		self.dirty = set()
+		rebuild = set(changed)
+		for key in set(key for cluster in changed for key in self._border_keys(cluster)):
+			old, new = self.borders.get(key, []), self._transitions(key)
+			if old == new:
+				continue
+			for a, b in old:
+				self.links[a].remove(b)
+				self.links[b].remove(a)
+			for a, b in new:
+				self.links[a].append(b)
+				self.links[b].append(a)
+			self.borders[key] = new
+			cx, cy, axis = key
+			rebuild.add((cx, cy))
+			rebuild.add((cx + 1, cy) if axis == 0 else (cx, cy + 1))
+		for cluster in rebuild:
+			self._build_edges(cluster)
+
+	def _nodes(self, cluster):
+		out = set()
+		for key in self._border_keys(cluster):
+			for pair in self.borders.get(key, ()):
+				out.update(cell for cell in pair if self._cluster(cell) == cluster)
+		return out
+
+	def _build_edges(self, cluster):
+		bounds = self._bounds(cluster)
+		nodes = self._nodes(cluster)
+		edges = self.edges[cluster] = {}
+		for node in nodes:
+			distances, _ = self._flood(node, bounds)
+			edges[node] = [(other, distances[other]) for other in nodes if other != node and other in distances]
+
+	def _flood(self, start, bounds, goal=None):
+		# breadth first search without leaving bounds; returns the distance and the previous cell for each reached cell
+		x1, y1, x2, y2 = bounds
+		distances = {start: 0}
+		parents = {start: None}
+		queue = collections.deque([start])
+		while queue:
+			cell = queue.popleft()
+			if cell == goal:
+				break
+			x, y = cell
+			for dx, dy in _STEPS:
+				nx, ny = x + dx, y + dy
+				if x1 <= nx < x2 and y1 <= ny < y2 and (nx, ny) not in distances and self._open(nx, ny):
+					distances[nx, ny] = distances[cell] + 1
+					parents[nx, ny] = cell
+					queue.append((nx, ny))
+		return distances, parents
+
+	@staticmethod
+	def _trace(parents, cell):
+		out = []
+		while cell is not None:
+			out.append(cell)
+			cell = parents[cell]
+		return out
+
+	def _local_path(self, start, goal, bounds):
+		_, parents = self._flood(start, bounds, goal)
+		if goal not in parents:
+			return None
+		return self._trace(parents, goal)[::-1]
+
+	def find_path(self, start, goal):
+		# the cells from start to goal (both included), or None if there's no way there
+		w = self.world
+		for x, y in (start, goal):
+			if not (0 <= x < w.width and 0 <= y < w.height and self._open(x, y)):
+				return None
+		self.refresh()
+		start_cluster, goal_cluster = self._cluster(start), self._cluster(goal)
+		if start_cluster == goal_cluster:
+			local = self._local_path(start, goal, self._bounds(start_cluster))
+			if local is not None:
+				return local
+		start_distances, start_parents = self._flood(start, self._bounds(start_cluster))
+		goal_distances, goal_parents = self._flood(goal, self._bounds(goal_cluster))
+		exits = dict((node, goal_distances[node]) for node in self._nodes(goal_cluster) if node in goal_distances)
+		# A* over the transitions, starting from the ones that start can reach in its own cluster
+		gx, gy = goal
+		costs = {start: 0}
+		previous = {start: None}
+		counter = itertools.count()
+		heap = [(0, 0, next(counter), start)]
+		while heap:
+			_, cost, _, node = heapq.heappop(heap)
+			if node == goal:
+				break
+			if cost > costs[node]:
+				continue
+			if node == start:
+				neighbors = [(other, start_distances[other]) for other in self._nodes(start_cluster) if other in start_distances]
+				neighbors += [(other, 1) for other in self.links.get(start, ())]
+			else:
+				neighbors = self.edges[self._cluster(node)][node] + [(other, 1) for other in self.links[node]]
+				if node in exits:
+					neighbors = neighbors + [(goal, exits[node])]
+			for other, step in neighbors:
+				total = cost + step
+				if total < costs.get(other, float("inf")):
+					costs[other] = total
+					previous[other] = node
+					heapq.heappush(heap, (total + abs(other[0] - gx) + abs(other[1] - gy), total, next(counter), other))
+		if goal not in previous:
+			return None
+		nodes = self._trace(previous, goal)[::-1]
+		# then fill in the cells between the transitions
+		cells = [start]
+		for a, b in zip(nodes, nodes[1:]):
+			if b in self.links.get(a, ()):
+				leg = [a, b]
+			elif a == start:
+				leg = self._trace(start_parents, b)[::-1]
+			elif b == goal:
+				leg = self._trace(goal_parents, a)
+			else:
+				leg = self._local_path(a, b, self._bounds(self._cluster(a)))
+			cells += leg[1:]
+		return cells
+
+
+class PathFollower:
+	# click-to-move: walks the entity along a path as a series of straight legs, each one a set_velocity plus a timer
+	# for when it should get to the end of it. anything else that moves the entity (like bumping into something) just
+	# means that the next leg starts from wherever it ended up; if a leg doesn't get any closer, the path gets dropped.
+	def __init__(self, speed):
+		self.speed = speed
+
+	def on_add(self, ent, world):
+		ent.path_timer = None
+		ent.waypoints = []
+		ent.waypoint_distance = float("inf")
+
+	def on_remove(self, ent, world):
+		self._cancel(ent)
+
+	def _cancel(self, ent):
+		if ent.path_timer is not None:
+			ent.path_timer.cancel()
+			ent.path_timer = None
+		ent.waypoints = []
+
+	def control_move(self, ent, rx, ry):
+		self._cancel(ent)  # steering by hand takes over from the path
+
+	@staticmethod
+	def _start_cell(ent, w):
+		# the cell under the entity's center, unless that one's solid (like a closed door that it's standing in), in
+		# which case it's the open cell closest to the center, out of the ones that its box overlaps and the center's
+		# neighbors
+		cw, ch = w.tileset.cell_size()
+		x, y = ent.get_pos(ent.now)
+		center = int(x // cw), int(y // ch)
+		if 0 <= center[0] < w.width and 0 <= center[1] < w.height and not w.is_solid(*center):
+			return center
+		sw, sh = ent.get_size() or (0, 0)
+		candidates = set((center[0] + dx, center[1] + dy) for dx, dy in _STEPS)
+		candidates.update(itertools.product(range(int((x - sw / 2) // cw), int((x + sw / 2) // cw) + 1),
+											range(int((y - sh / 2) // ch), int((y + sh / 2) // ch) + 1)))
+		candidates = [(cx, cy) for cx, cy in candidates if 0 <= cx < w.width and 0 <= cy < w.height and not w.is_solid(cx, cy)]
+		if not candidates:
+			return center
+		return min(candidates, key=lambda cell: ((cell[0] + 0.5) * cw - x) ** 2 + ((cell[1] + 0.5) * ch - y) ** 2)
+
+	def move_to(self, ent, cx, cy):
+		w = ent.world
+		cw, ch = w.tileset.cell_size()
+		cells = w.get_pathfinder().find_path(self._start_cell(ent, w), (cx, cy))
+		if cells is None:
+			return  # nowhere to go, so keep going wherever it was going
+		self._cancel(ent)
+		ent.waypoints = [((x + 0.5) * cw, (y + 0.5) * ch) for x, y in _corners(cells)]
+		ent.waypoint_distance = float("inf")
+		self._next_leg(ent)
+
+	def _next_leg(self, ent):
+		ent.path_timer = None
+		x, y = ent.get_pos(ent.now)
+		while ent.waypoints:
+			wx, wy = ent.waypoints[0]
+			distance = math.hypot(wx - x, wy - y)
+			if distance > ARRIVAL_TOLERANCE:
+				break
+			ent.waypoints.pop(0)
+			ent.waypoint_distance = float("inf")
+		else:
+			ent.set_velocity(0, 0)
+			return
+		if distance >= ent.waypoint_distance - ARRIVAL_TOLERANCE:
+			ent.waypoints = []  # stuck
+			ent.set_velocity(0, 0)
+			return
+		ent.waypoint_distance = distance
+		ent.set_velocity((wx - x) * self.speed / distance, (wy - y) * self.speed / distance)
+		ent.path_timer = ent.world.time_provider.add_timer(distance / self.speed, self._next_leg, ent)
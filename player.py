@@ -1,6 +1,7 @@
 __author__ = 'colby'
 
 import entity
+import pathfind
 
 PLAYER_SPEED = 64
 
@@ -8,5 +9,7 @@ PLAYER_SPEED = 64
 Player = entity.EntityType(
 	entity.RenderImage("pyramid_small.png"),
 	entity.GridCollider(),
+	entity.EntityCollider(),
+	pathfind.PathFollower(PLAYER_SPEED),
 	lambda x, y: entity.PositionVelocity(x, y, 0, 0),
 	lambda gui_cb: entity.Controllable(PLAYER_SPEED, gui_cb))
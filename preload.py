@@ -0,0 +1,175 @@
+__author__ = 'colby'
+
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import struct
+import sdl_ll
+
+# the decoded pixel cache: a header, a table of entries, and then each image's RGBA pixels, which get used in place
+# through mmap, so that a warm start doesn't decode anything at all.
+CACHE_FILE = ".decoded-cache"
+MAGIC = b"TKLD"
+VERSION = 1
+HEADER = struct.Struct("<4sHxxI")  # magic, version, entry count
+ENTRY = struct.Struct("<20sIIQH")  # sha1 of the source file, width, height, offset of the pixels, name length
+ALIGN = 16
+WORKERS = 4
+
+
+def images_of(thing):
+	# the images that something will draw: image names themselves, anything with an image or images attribute (like
+	# Tilesets, RenderImages and GUIs), and the components of entity and tile types
+	if isinstance(thing, str):
+		return {thing}
+	out = set()
+	if isinstance(getattr(thing, "image", None), str):
+		out.add(thing.image)
+	out.update(getattr(thing, "images", ()))
+	for component in getattr(thing, "components", ()):
+		out |= images_of(component)
+	return out
+
+
+def manifest(things):
+	out = set()
+	for thing in things:
+		out |= images_of(thing)
+	return sorted(out)
+
+
+def _hash(path):
+	with open(path, "rb") as f:
+		return hashlib.sha1(f.read()).digest()
+
+
+def _decode(path):
+	surface = sdl_ll.image(path)
+	try:
+		w, h = surface.get_size()
+		return w, h, surface.to_rgba()
+	finally:
+		surface.destroy()
+
+
+def read_cache(path):
+	# returns (the mapped file, or None if there's no usable one, and name -> (source hash, width, height, pixels)),
+	# where the pixels are views into the mapped file
+	try:
+		with open(path, "rb") as f:
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	except (OSError, ValueError):
+		return None, {}  # missing or empty
+	entries = _read_entries(data)
+	if not entries:
+		data.close()
+		return None, {}
+	return data, entries
+
+
+def _read_entries(data):
+	try:
+		magic, version, count = HEADER.unpack_from(data, 0)
+		if magic != MAGIC or version != VERSION:
+			return {}
+		out = {}
+		offset = HEADER.size
+		view = memoryview(data)
+		for _ in range(count):
+			source_hash, w, h, pixels, name_length = ENTRY.unpack_from(data, offset)
+			offset += ENTRY.size
+			name = bytes(data[offset:offset + name_length]).decode()
+			offset += name_length
+			if pixels + w * h * 4 > len(data):
+				return {}
+			out[name] = source_hash, w, h, view[pixels:pixels + w * h * 4]
+		return out
+	except struct.error:
+		return {}
+
+
+def write_cache(path, images):
+	# images is name -> (source hash, width, height, pixels)
+	names = sorted(images)
+	table_size = HEADER.size + sum(ENTRY.size + len(name.encode()) for name in names)
+	parts = [HEADER.pack(MAGIC, VERSION, len(names))]
+	offset = table_size
+	offsets = []
+	for name in names:
+		offset += -offset % ALIGN
+		offsets.append(offset)
+		offset += len(images[name][3])
+	for name, pixels_offset in zip(names, offsets):
+		source_hash, w, h, pixels = images[name]
+		encoded = name.encode()
+		parts.append(ENTRY.pack(source_hash, w, h, pixels_offset, len(encoded)) + encoded)
+	position = table_size
+	for name, pixels_offset in zip(names, offsets):
+		parts.append(bytes(pixels_offset - position))
+		parts.append(images[name][3])
+		position = pixels_offset + len(images[name][3])
+	with open(path + ".tmp", "wb") as f:
+		f.writelines(parts)
+	os.replace(path + ".tmp", path)
+
+
+class Preloader:
+	# gets images ready ahead of time: the ones in the decoded pixel cache are ready immediately, and the rest get
+	# decoded on a thread pool (SDL_image doesn't need the GIL while decoding), after which the cache gets updated.
+	def __init__(self, directory, names, workers=WORKERS):
+		self.directory = directory
+		self.names = list(names)
+		self.cache_path = os.path.join(directory, CACHE_FILE)
+		self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+		self.cache, cached = read_cache(self.cache_path)
+		self.images = {}  # name -> (source hash, width, height, pixels), once available
+		self.futures = {}
+		decoding = []
+		for name in names:
+			path = os.path.join(directory, name)
+			source_hash = _hash(path)
+			entry = cached.get(name)
+			if entry is not None and entry[0] == source_hash:
+				self.images[name] = entry
+				future = concurrent.futures.Future()
+				future.set_result(entry)
+			else:
+				future = self.pool.submit(self._decode, name, path, source_hash)
+				decoding.append(future)
+			self.futures[name] = future
+		if decoding:
+			self.pool.submit(self._update_cache, decoding)
+
+	def _decode(self, name, path, source_hash):
+		w, h, pixels = _decode(path)
+		entry = self.images[name] = source_hash, w, h, pixels
+		return entry
+
+	def _update_cache(self, decoding):
+		concurrent.futures.wait(decoding)
+		if all(future.exception() is None for future in decoding):
+			try:
+				write_cache(self.cache_path, self.images)
+			except OSError:
+				pass  # not being able to cache it is fine
+
+	def get(self, name):
+		# the image as a Surface, which only has to wait if it's still being decoded, or None if it isn't preloaded
+		future = self.futures.get(name)
+		if future is None:
+			return None
+		source_hash, w, h, pixels = future.result()
+		return sdl_ll.surface_from_rgba(pixels, w, h)
+
+	def shutdown(self):
+		# waits for any decoding and cache writing to finish, and lets go of the cache
+		self.pool.shutdown()
+		self.images = {}
+		self.futures = {}
+		if self.cache is not None:
+			try:
+				self.cache.close()
+			except BufferError:
+				pass  # surfaces made from it are still around, so it gets closed once they're gone
+			self.cache = None
@@ -1,6 +1,7 @@
 __author__ = 'colby'
 
 import sdl  # pysdl2-cffi
+import array
 import atexit
 import weakref
 
@@ -23,6 +24,17 @@ def check(handle, err):
 	assert handle
 	return handle
 
+_render_geometry_raw = getattr(sdl, "renderGeometryRaw", None)  # only in SDL 2.0.18 and later
+_white = sdl.ffi.new("SDL_Color *", (255, 255, 255, 255)) if _render_geometry_raw is not None else None
+_indices = array.array("i")
+
+
+def _quad_indices(count):
+	# two triangles per quad, shared between all batches and only ever grown
+	for base in range(len(_indices) // 6 * 4, count * 4, 4):
+		_indices.extend((base, base + 1, base + 2, base, base + 2, base + 3))
+	return _indices
+
 _windows = weakref.WeakValueDictionary()
 class Window:
 	sdl_destroyWindow = sdl.destroyWindow  # moved here to prevent shutdown issues
@@ -36,8 +48,8 @@ class Window:
 		self.size = width, height
 		_windows[self.winid] = self
 
-	def create_renderer(self):
-		return Renderer(self)
+	def create_renderer(self, vsync=False):
+		return Renderer(self, vsync)
 
 	def destroy(self):
 		if self.handle is not None:
@@ -53,11 +65,11 @@ class Window:
 class Renderer:
 	sdl_destroyRenderer = sdl.destroyRenderer
 
-	def __init__(self, window):
+	def __init__(self, window, vsync=False):
 		assert window.handle is not None
 		self.window = window
-		# sdl.RENDERER_PRESENTVSYNC
-		self.handle = check(sdl.createRenderer(window.handle, -1, sdl.RENDERER_ACCELERATED | 0), "Could not create renderer")
+		flags = sdl.RENDERER_ACCELERATED | (sdl.RENDERER_PRESENTVSYNC if vsync else 0)
+		self.handle = check(sdl.createRenderer(window.handle, -1, flags), "Could not create renderer")
 
 	def clear(self):
 		assert self.handle is not None
@@ -76,6 +88,45 @@ class Renderer:
 		if sdl.renderCopy(self.handle, texture.handle, srcrect, dstrect) != 0:
 			raise SDLException("Could not render texture")
 
+	def copy_quads(self, texture, xy, uv):
+		# xy and uv are float arrays with four (x, y) corners per quad, clockwise from the top-left
+		assert self.handle is not None
+		assert isinstance(texture, Texture) and texture.handle is not None
+		count = len(xy) // 8
+		if _render_geometry_raw is not None:
+			indices = _quad_indices(count)
+			if _render_geometry_raw(self.handle, texture.handle, sdl.ffi.from_buffer("float[]", xy), 8, _white, 0,
+									sdl.ffi.from_buffer("float[]", uv), 8, count * 4,
+									sdl.ffi.from_buffer("int[]", indices), count * 6, 4) != 0:
+				raise SDLException("Could not render geometry")
+		else:
+			# older SDL: still one call per quad, but without any of the per-sprite lookups
+			tw, th = texture.get_size()
+			handle, thandle, copy = self.handle, texture.handle, sdl.renderCopy
+			for i in range(0, count * 8, 8):
+				srcrect = round(uv[i] * tw), round(uv[i + 1] * th), round((uv[i + 2] - uv[i]) * tw), round((uv[i + 5] - uv[i + 1]) * th)
+				dstrect = round(xy[i]), round(xy[i + 1]), round(xy[i + 2] - xy[i]), round(xy[i + 5] - xy[i + 1])
+				if copy(handle, thandle, srcrect, dstrect) != 0:
+					raise SDLException("Could not render texture")
+
+	def fill_rect(self, rect, color, blend=True):
+		assert self.handle is not None
+		sdl.setRenderDrawBlendMode(self.handle, sdl.BLENDMODE_BLEND if blend else sdl.BLENDMODE_NONE)
+		sdl.setRenderDrawColor(self.handle, color[0], color[1], color[2], color[3] if len(color) > 3 else 255)
+		if sdl.renderFillRect(self.handle, rect) != 0:
+			raise SDLException("Could not fill rectangle")
+
+	def create_target(self, width, height):
+		assert self.handle is not None
+		texture = Texture(check(sdl.createTexture(self.handle, sdl.PIXELFORMAT_RGBA8888, sdl.TEXTUREACCESS_TARGET, width, height), "Could not create target texture"))
+		sdl.setTextureBlendMode(texture.handle, sdl.BLENDMODE_BLEND)
+		return texture
+
+	def set_target(self, texture=None):
+		assert self.handle is not None
+		if sdl.setRenderTarget(self.handle, texture.handle if texture is not None else None) != 0:
+			raise SDLException("Could not set render target")
+
 	def present(self):
 		assert self.handle is not None
 		assert sdl.renderPresent(self.handle) is None
@@ -94,6 +145,7 @@ class Renderer:
 class Surface:
 	def __init__(self, handle):
 		self.handle = check(handle, "Bad surface")
+		self.buffer = None  # the pixels that it uses in place, if any (see surface_from_rgba)
 
 	def to_texture(self, renderer):
 		assert isinstance(renderer, Renderer) and renderer.handle is not None
@@ -104,6 +156,7 @@ class Surface:
 		if self.handle is not None:
 			# sdl_destroySurface(self.handle)
 			self.handle = None
+			self.buffer = None
 
 	def __del__(self):
 		if self.handle is not None:
@@ -113,11 +166,32 @@ class Surface:
 	def get_size(self):
 		return self.handle.w, self.handle.h
 
+	def to_rgba(self):
+		# the pixels, as tightly packed RGBA bytes
+		converted = check(sdl.convertSurfaceFormat(self.handle, sdl.PIXELFORMAT_RGBA32, 0), "Could not convert surface")
+		try:
+			w, h, pitch = converted.w, converted.h, converted.pitch
+			data = sdl.ffi.buffer(sdl.ffi.cast("char *", converted.pixels), pitch * h)
+			return b"".join(data[y * pitch:y * pitch + w * 4] for y in range(h))
+		finally:
+			sdl.freeSurface(converted)
+
+	def blit(self, source, x, y):
+		# copies source in as-is, alpha included, instead of blending it over what's already there
+		assert self.handle is not None and source.handle is not None
+		sdl.setSurfaceBlendMode(source.handle, sdl.BLENDMODE_NONE)
+		w, h = source.get_size()
+		result = sdl.upperBlit(source.handle, None, self.handle, (x, y, w, h))
+		sdl.setSurfaceBlendMode(source.handle, sdl.BLENDMODE_BLEND)
+		if result != 0:
+			raise SDLException("Could not blit surface")
+
 class Texture:
 	sdl_destroyTexture = sdl.destroyTexture
 
 	def __init__(self, handle):
 		self.handle = check(handle, "Bad texture")
+		self.size = None
 
 	def destroy(self):
 		if self.handle is not None:
@@ -130,35 +204,158 @@ class Texture:
 			self.destroy()
 
 	def get_size(self):
-		out = sdl.queryTexture(self.handle)
-		assert out[0] == 0, "invalid texture"
-		return out[3], out[4]
+		if self.size is None:
+			out = sdl.queryTexture(self.handle)
+			assert out[0] == 0, "invalid texture"
+			self.size = out[3], out[4]
+		return self.size
+
+
+class SpriteBatch:
+	# collects textured quads per texture, so that each texture can be drawn with one call when flushed.
+	# textures are flushed in the order they were first used, so overlaps between different textures can reorder.
+	def __init__(self, renderer):
+		self.renderer = renderer
+		self.queues = {}  # texture -> (xy, uv)
+		self.spare = []
+
+	def _queue(self, texture):
+		queue = self.queues.get(texture)
+		if queue is None:
+			queue = self.queues[texture] = self.spare.pop() if self.spare else (array.array("f"), array.array("f"))
+		return queue
+
+	def add(self, texture, srcrect, dstrect):
+		queue = self._queue(texture)
+		tw, th = texture.get_size()
+		sx, sy, sw, sh = srcrect if srcrect is not None else (0, 0, tw, th)
+		dx, dy, dw, dh = dstrect
+		queue[0].extend((dx, dy, dx + dw, dy, dx + dw, dy + dh, dx, dy + dh))
+		u1, v1, u2, v2 = sx / tw, sy / th, (sx + sw) / tw, (sy + sh) / th
+		queue[1].extend((u1, v1, u2, v1, u2, v2, u1, v2))
+
+	def add_quads(self, texture, xy, uv):
+		# many quads at once: xy and uv are buffers of floats laid out like for copy_quads
+		queue = self._queue(texture)
+		queue[0].frombytes(memoryview(xy).cast("B"))
+		queue[1].frombytes(memoryview(uv).cast("B"))
+
+	def flush(self):
+		for texture, (xy, uv) in self.queues.items():
+			self.renderer.copy_quads(texture, xy, uv)
+			del xy[:], uv[:]
+			self.spare.append((xy, uv))
+		self.queues.clear()
 
 def image(name):
 	return Surface(check(sdl.image.load(name), "Could not load image"))
 
 
+def surface_from_rgba(pixels, width, height):
+	# wraps tightly packed RGBA pixels without copying them; the surface keeps the buffer alive
+	buffer = sdl.ffi.from_buffer(pixels)
+	surface = Surface(sdl.createRGBSurfaceWithFormatFrom(buffer, width, height, 32, width * 4, sdl.PIXELFORMAT_RGBA32))
+	surface.buffer = buffer
+	return surface
+
+
+def create_surface(width, height):
+	# a blank (fully transparent) RGBA surface
+	return Surface(sdl.createRGBSurfaceWithFormat(0, width, height, 32, sdl.PIXELFORMAT_RGBA8888))
+
+
 def delay(millis):
 	sdl.delay(millis)
 
 
-_event = sdl.Event()
-
-def pump(on_quit=None, on_key_down=None, on_key_up=None, on_mouse_motion=None, on_mouse_down=None, on_mouse_up=None, on_mouse_wheel=None):
-	while sdl.pollEvent(_event):
-		if _event.type == sdl.QUIT and on_quit:
-			on_quit()
-		elif _event.type == sdl.KEYDOWN and on_key_down:
-			on_key_down(_windows[_event.key.windowID], _event.key.keysym.sym, _event.key.keysym.scancode, _event.key.keysym.mod, _event.key.repeat)
-		elif _event.type == sdl.KEYUP and on_key_up:
-			on_key_up(_windows[_event.key.windowID], _event.key.keysym.sym, _event.key.keysym.scancode, _event.key.keysym.mod)
-		elif _event.type == sdl.MOUSEMOTION and on_mouse_motion:
-			on_mouse_motion(_windows[_event.motion.windowID], _event.motion.x, _event.motion.y, _event.motion.state)
-		elif _event.type == sdl.MOUSEBUTTONDOWN and on_mouse_down:
-			on_mouse_down(_windows[_event.button.windowID], _event.button.x, _event.button.y, _event.button.button, _event.button.clicks)
-		elif _event.type == sdl.MOUSEBUTTONUP and on_mouse_up:
-			on_mouse_up(_windows[_event.button.windowID], _event.button.x, _event.button.y, _event.button.button, _event.button.clicks)
-		elif _event.type == sdl.MOUSEWHEEL and on_mouse_wheel:
-			on_mouse_wheel(_windows[_event.wheel.windowID], _event.wheel.x, _event.wheel.y, _event.wheel.direction == sdl.MOUSEWHEEL_FLIPPED)
-		else:
-			pass  # ignore it and try again
+def wait(millis=None):
+	# blocks until an event is available (without taking it off the queue) or the timeout runs out
+	if millis is None:
+		return sdl.waitEvent(None) != 0
+	return sdl.waitEventTimeout(None, millis) != 0
+
+
+EVENT_BATCH = 64  # events taken off of SDL's queue at a time
+_events = sdl.ffi.new("SDL_Event[]", EVENT_BATCH)
+
+
+class EventTable:
+	# event type -> handler, built once per set of callbacks, so that dispatching an event is one dict lookup.
+	# callbacks get window_owner(window) for the Window that an event happened in, instead of the Window itself.
+	# consecutive mouse motion events only produce one on_mouse_motion call, with the last position.
+	def __init__(self, window_owner=None, on_quit=None, on_key_down=None, on_key_up=None, on_mouse_motion=None, on_mouse_down=None, on_mouse_up=None, on_mouse_wheel=None):
+		self.window_owner = window_owner
+		self.owners = {}  # window id -> owner, only for the duration of a pump
+		self.on_mouse_motion = on_mouse_motion
+		owner = self._owner
+		handlers = {}
+		if on_quit:
+			handlers[sdl.QUIT] = lambda event: on_quit()
+		if on_key_down:
+			handlers[sdl.KEYDOWN] = lambda event: on_key_down(owner(event.key.windowID), event.key.keysym.sym, event.key.keysym.scancode, event.key.keysym.mod, event.key.repeat)
+		if on_key_up:
+			handlers[sdl.KEYUP] = lambda event: on_key_up(owner(event.key.windowID), event.key.keysym.sym, event.key.keysym.scancode, event.key.keysym.mod)
+		if on_mouse_down:
+			handlers[sdl.MOUSEBUTTONDOWN] = lambda event: on_mouse_down(owner(event.button.windowID), event.button.x, event.button.y, event.button.button, event.button.clicks)
+		if on_mouse_up:
+			handlers[sdl.MOUSEBUTTONUP] = lambda event: on_mouse_up(owner(event.button.windowID), event.button.x, event.button.y, event.button.button, event.button.clicks)
+		if on_mouse_wheel:
+			handlers[sdl.MOUSEWHEEL] = lambda event: on_mouse_wheel(owner(event.wheel.windowID), event.wheel.x, event.wheel.y, event.wheel.direction == sdl.MOUSEWHEEL_FLIPPED)
+		self.handlers = handlers
+
+	def _owner(self, winid):
+		owner = self.owners.get(winid)
+		if owner is None:
+			window = _windows.get(winid)
+			owner = self.owners[winid] = self.window_owner(window) if self.window_owner and window is not None else window
+		return owner
+
+	def _motion(self, event):
+		return event.motion.windowID, event.motion.x, event.motion.y, event.motion.state
+
+	def _flush_motion(self, motion):
+		winid, x, y, state = motion
+		self.on_mouse_motion(self._owner(winid), x, y, state)
+
+	def pump(self):  # returns how many events there were
+		sdl.pumpEvents()
+		get = self.handlers.get
+		coalesce = self.on_mouse_motion is not None
+		motion_type = sdl.MOUSEMOTION
+		motion = None  # the latest of a run of motion events, as (window id, x, y, state)
+		last_motion = None  # or just its index in the current batch, until the batch gets reused
+		total = 0
+		try:
+			while True:
+				count = sdl.peepEvents(_events, EVENT_BATCH, sdl.GETEVENT, sdl.FIRSTEVENT, sdl.LASTEVENT)
+				if count < 0:
+					count = 0  # no event subsystem (like when running headless), so there can't be any events
+				total += count
+				for i in range(count):
+					event = _events[i]
+					kind = event.type
+					if kind == motion_type and coalesce:
+						if last_motion is not None and _events[last_motion].motion.windowID != event.motion.windowID:
+							self._flush_motion(self._motion(_events[last_motion]))
+						elif motion is not None and motion[0] != event.motion.windowID:
+							self._flush_motion(motion)
+						motion, last_motion = None, i
+						continue
+					if last_motion is not None:
+						self._flush_motion(self._motion(_events[last_motion]))
+						last_motion = None
+					elif motion is not None:
+						self._flush_motion(motion)
+						motion = None
+					handler = get(kind)
+					if handler is not None:
+						handler(event)
+				if last_motion is not None:
+					motion, last_motion = self._motion(_events[last_motion]), None
+				if count < EVENT_BATCH:
+					break
+			if motion is not None:
+				self._flush_motion(motion)
+		finally:
+			self.owners.clear()
+		return total
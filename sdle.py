@@ -1,20 +1,39 @@
 __author__ = 'colby'
 
+import array
+import asyncio
 import sdl_ll
+import atlas
+import math
 import time
-import heapq
 import os
 import atexit
+import preload
+import timers
 
 _images = {}
-def _cleanup_images():
+_preloader = None
+
+def release_images():
+	# destroys the loaded images and shuts the preloader down; for when nothing is going to draw anymore
+	global _preloader
 	for image in _images.values():
 		image.destroy()
-atexit.register(_cleanup_images)
+	_images.clear()
+	if _preloader is not None:
+		_preloader.shutdown()
+		_preloader = None
+atexit.register(release_images)
+
+def preload_images(names):
+	# starts getting these images ready in the background, so that nothing has to wait on decoding them later
+	global _preloader
+	_preloader = preload.Preloader("assets", names)
 
 def _get_image(name):
 	if name not in _images:
-		_images[name] = sdl_ll.image(os.path.join("assets", name))
+		surface = _preloader.get(name) if _preloader is not None else None
+		_images[name] = surface if surface is not None else sdl_ll.image(os.path.join("assets", name))
 	return _images[name]
 
 def get_image_size(name):
@@ -27,15 +46,26 @@ def round_rect(rect):
 		return round(x), round(y), round(w), round(h)
 
 class Window:
-	def __init__(self, title, width, height):
+	def __init__(self, title, width, height, vsync=False, use_atlas=True):
 		self.window = sdl_ll.Window(title, width, height)
 		self.window.sdle_window = self
-		self.renderer = self.window.create_renderer()
+		self.renderer = self.window.create_renderer(vsync)
 		self.texture_cache = {}
+		# all of the assets get packed into a few shared textures, and images only get their own texture otherwise
+		# (just the preloaded ones, if there are any)
+		names = _preloader.names if _preloader is not None else None
+		self.atlas = atlas.Atlas(self.renderer, "assets", _get_image, names) if use_atlas else None
+		self.layers = set()
+		self.batch = sdl_ll.SpriteBatch(self.renderer)
+		self.batching = False
 
 	def destroy(self):
 		for texture in self.texture_cache.values():
 			texture.destroy()
+		for layer in self.layers:
+			layer.destroy()
+		if self.atlas is not None:
+			self.atlas.destroy()
 		self.renderer.destroy()
 		self.window.destroy()
 
@@ -47,6 +77,7 @@ class Window:
 			x1, y1 = x1
 		else:
 			assert color is not None
+		self._flush()
 		self.renderer.draw_line(x1, y1, x2, y2, color)
 
 	def _get_image(self, name):
@@ -55,8 +86,74 @@ class Window:
 			self.texture_cache[name] = texture
 		return self.texture_cache[name]
 
+	def _lookup(self, name, srcrect):
+		if self.atlas is not None:
+			found = self.atlas.lookup(name, srcrect)
+			if found is not None:
+				return found
+		return self._get_image(name), srcrect
+
 	def draw_image(self, name, srcrect=None, dstrect=None):
-		self.renderer.copy(self._get_image(name), round_rect(srcrect), round_rect(dstrect))
+		texture, srcrect = self._lookup(name, srcrect)
+		if self.batching and dstrect is not None:
+			self.batch.add(texture, srcrect, dstrect)
+		else:
+			self._flush()
+			self.renderer.copy(texture, round_rect(srcrect), round_rect(dstrect))
+
+	def draw_quads(self, name, srcrect, xy, count):
+		# draws the same image (or part of one) into count places at once; xy is a buffer of floats with the four
+		# corners of each place, laid out like for copy_quads
+		texture, srcrect = self._lookup(name, srcrect)
+		tw, th = texture.get_size()
+		sx, sy, sw, sh = srcrect if srcrect is not None else (0, 0, tw, th)
+		u1, v1, u2, v2 = sx / tw, sy / th, (sx + sw) / tw, (sy + sh) / th
+		uv = array.array("f", (u1, v1, u2, v1, u2, v2, u1, v2)) * count
+		if self.batching:
+			self.batch.add_quads(texture, xy, uv)
+		else:
+			# copy_quads wants it flat, whatever shape it came in
+			self.renderer.copy_quads(texture, memoryview(xy).cast("B").cast("f"), uv)
+
+	def begin_batch(self):
+		# until end_batch, images get queued up per texture instead of being drawn one at a time.
+		# anything else that gets drawn in the meantime flushes the queue first, to keep the drawing order.
+		self.batching = True
+
+	def end_batch(self):
+		self.batch.flush()
+		self.batching = False
+
+	def _flush(self):
+		if self.batching:
+			self.batch.flush()
+
+	def create_layer(self, width, height):
+		# an offscreen texture that can be drawn into with begin_layer, and then drawn in one go with draw_layer
+		layer = self.renderer.create_target(width, height)
+		self.layers.add(layer)
+		return layer
+
+	def destroy_layer(self, layer):
+		self.layers.remove(layer)
+		layer.destroy()
+
+	def begin_layer(self, layer):
+		self._flush()
+		self.renderer.set_target(layer)
+
+	def end_layer(self):
+		self._flush()
+		self.renderer.set_target(None)
+
+	def draw_layer(self, layer, x, y):
+		self._flush()
+		w, h = layer.get_size()
+		self.renderer.copy(layer, None, round_rect((x, y, w, h)))
+
+	def clear_rect(self, rect):
+		self._flush()
+		self.renderer.fill_rect(round_rect(rect), (0, 0, 0, 0), blend=False)
 
 	def draw_image_centered(self, name, srcrect=None, cx=None, cy=None):
 		assert cx is not None
@@ -76,59 +173,80 @@ class Window:
 		return self.window.size
 
 
-class EventLoop:
+Timer = timers.Timer
+
+
+class EventLoop(timers.TimerLoop):
 	def __init__(self, **events):
-		# wrap the callbacks so that they convert to sdle windows
-		self.events = dict((key, EventLoop._wrap_cb(orig)) for key, orig in events.items() if key != "on_quit")
-		if "on_quit" in events:
-			self.events["on_quit"] = events["on_quit"]
-		self.timers = []
-		self.entryid = 0
-		self._now = time.monotonic()
+		timers.TimerLoop.__init__(self, time.monotonic())
+		# the dispatch table gets built once, and hands the callbacks sdle windows
+		self.events = sdl_ll.EventTable(lambda window: window.sdle_window, **events)
+
+	def clock(self):
+		return time.monotonic()
+
+	def pump(self):  # returns whether anything happened
+		ran = self.run_timers(time.monotonic())
+		return self.events.pump() > 0 or ran
+
+	def instrument(self, stats):
+		timers.TimerLoop.instrument(self, stats)
+		self.pump = self._pump_instrumented
+
+	def uninstrument(self):
+		if self.stats is not None:
+			del self.pump
+		timers.TimerLoop.uninstrument(self)
+
+	def _pump_instrumented(self):
+		start = time.perf_counter()
+		out = EventLoop.pump(self)
+		self.stats.add("loop.pump", time.perf_counter() - start)
+		return out
+
+	def wait_until(self, mono):
+		# sleeps until mono, or until there's input to handle
+		if mono == float("inf"):
+			sdl_ll.wait()
+		else:
+			millis = math.ceil((mono - time.monotonic()) * 1000)
+			if millis > 0:
+				sdl_ll.wait(millis)
 
-	@staticmethod
-	def do_nothing():
-		pass
 
-	@staticmethod
-	def _wrap_cb(orig):
-		return lambda winraw, *args: orig(winraw.sdle_window, *args)
+INPUT_INTERVAL = 0.004  # seconds between checks for input, when running under asyncio (SDL has nothing to wait on)
 
-	def now(self):
-		return self._now
 
-	def on_next(self, cb, *args):
-		self.add_timer(0, cb, *args)
+class AsyncEventLoop(timers.AsyncioTimerLoop):
+	# an EventLoop for running inside of asyncio: asyncio owns the timers, and input gets pumped by a task of its own
+	def __init__(self, aio=None, **events):
+		timers.AsyncioTimerLoop.__init__(self, aio)
+		self.events = sdl_ll.EventTable(lambda window: window.sdle_window, **events)
 
-	def add_timer_at(self, mono, cb, *args):
-		if mono == float("inf"):
-			return EventLoop.do_nothing  # don't even bother
-		tup = (mono, self.entryid, cb) + tuple(args)
-		heapq.heappush(self.timers, tup)
-		self.entryid += 1
-
-		def remove():
-			if not self.timers or self.timers[0][0] > mono:
-				return
-			self.timers[self.timers.index(tup)] = (mono, tup[1], EventLoop.do_nothing)
-		return remove
-
-	def add_timer(self, timeout, cb, *args):
-		return self.add_timer_at(self.now() + timeout, cb, *args)
-
-	def add_interval(self, interval, cb, *args):
-		def wrap_cb():
-			self.add_timer(interval, wrap_cb)
-			cb(*args)
-		self.add_timer(interval, wrap_cb)
-
-	def pump(self):
-		now = time.monotonic()
-		while self.timers and self.timers[0][0] <= now:
-			timer = heapq.heappop(self.timers)
-			self._now = timer[0]
-			timer[2](*timer[3:])
-		self._now = now
-		sdl_ll.pump(**self.events)
+	def pump(self):  # returns whether anything happened
+		if self.events.pump() > 0:
+			self.activity.set()
+			return True
+		return False
+
+	async def pump_forever(self, interval=INPUT_INTERVAL):
+		while True:
+			self.pump()
+			await asyncio.sleep(interval)
+
+	def instrument(self, stats):
+		timers.AsyncioTimerLoop.instrument(self, stats)
+		self.pump = self._pump_instrumented
+
+	def uninstrument(self):
+		if self.stats is not None:
+			del self.pump
+		timers.AsyncioTimerLoop.uninstrument(self)
+
+	def _pump_instrumented(self):
+		start = time.perf_counter()
+		out = AsyncEventLoop.pump(self)
+		self.stats.add("loop.pump", time.perf_counter() - start)
+		return out
 
 delay = sdl_ll.delay
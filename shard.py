@@ -0,0 +1,248 @@
+__author__ = 'colby'
+
+import array
+import multiprocessing
+
+import timers
+import world
+
+# the halo has to be wide enough that nothing can get from a shard's own region to the edge of its World within one
+# step, or else it would bump into the (solid) outside of the shard before getting handed off.
+HALO_CELLS = 4
+STEP = 0.1  # seconds of simulated time between handoffs
+
+
+def plan_shards(width, height, columns, rows):
+	# splits a map into columns x rows regions of cells, as (x1, y1, x2, y2) with exclusive ends
+	xs = [width * i // columns for i in range(columns + 1)]
+	ys = [height * j // rows for j in range(rows + 1)]
+	return [(xs[i], ys[j], xs[i + 1], ys[j + 1]) for i in range(columns) for j in range(rows)]
+
+
+def _resolve(ref):
+	base, attr = ref.rsplit(".", 1)
+	return getattr(__import__(base), attr)
+
+
+def _merge_segments(segments):
+	# joins segments that continue each other along the same line, like the ones cut apart at shard boundaries
+	out = []
+	for dep, start, end in sorted(segments):
+		if out and out[-1][0] == dep and out[-1][2] == start:
+			out[-1] = dep, out[-1][1], end
+		else:
+			out.append((dep, start, end))
+	return out
+
+
+class _Proxy:
+	# just enough of an entity for its renderers to draw it from a pos_vel_time record
+	def __init__(self, pos_vel_time):
+		self.pos_vel_time = pos_vel_time
+
+	def get_pos(self, now):
+		x, y, vx, vy, start_time = self.pos_vel_time
+		return x + vx * (now - start_time), y + vy * (now - start_time)
+
+
+class Shard:
+	# lives in a worker process: a World covering one region of the map, plus a halo of cells around it, running on
+	# its own virtual clock. entities are only owned by the shard whose region they're in; everything here talks in
+	# map-wide pixel coordinates, and converts to and from the coordinates of the shard's World.
+	def __init__(self, region, bounds, map_size, cells, icons, solid_tiles, tileset, kinds, start):
+		self.region, self.bounds, self.map_size = region, bounds, map_size
+		self.clock = timers.VirtualClock(start)
+		bx1, by1, bx2, by2 = bounds
+		self.world = world.World.from_cells(bx2 - bx1, by2 - by1, icons, cells, world.Tileset(*tileset), solid_tiles, self.clock)
+		self.cw, self.ch = self.world.tileset.cell_size()
+		self.offset = bx1 * self.cw, by1 * self.ch
+		self.kinds = dict((name, _resolve(ref)) for name, ref in kinds.items())
+		self.owned = {}  # entity -> (entity id, kind)
+
+	def _owns(self, x, y):
+		x1, y1, x2, y2 = self.region
+		return x1 * self.cw <= x < x2 * self.cw and y1 * self.ch <= y < y2 * self.ch
+
+	def add(self, records):
+		ox, oy = self.offset
+		for eid, kind, (x, y, vx, vy, start_time) in records:
+			ent = self.world.add_entity(self.kinds[kind](x - ox, y - oy))
+			# the motion is piecewise linear, so the record is all there is to carry over
+			ent.pos_vel_time = x - ox, y - oy, vx, vy, start_time
+			self.owned[ent] = eid, kind
+
+	def _record(self, ent):
+		ox, oy = self.offset
+		x, y, vx, vy, start_time = ent.pos_vel_time
+		eid, kind = self.owned[ent]
+		return eid, kind, (x + ox, y + oy, vx, vy, start_time)
+
+	def run_until(self, mono):
+		# returns the records of the entities that left the region, which aren't part of this shard anymore
+		self.clock.run_until(mono)
+		ox, oy = self.offset
+		leaving = []
+		for ent in list(self.owned):
+			x, y = ent.get_pos(mono)
+			if not self._owns(x + ox, y + oy):
+				leaving.append(self._record(ent))
+				del self.owned[ent]
+				self.world.remove_entity(ent)
+		return leaving
+
+	def states(self):
+		return [self._record(ent) for ent in self.owned]
+
+	def set_icon(self, x, y, icon):
+		bx1, by1, bx2, by2 = self.bounds
+		if bx1 <= x < bx2 and by1 <= y < by2:
+			self.world.update_icon_only(x - bx1, y - by1, icon)
+
+	def segments(self):
+		# the wall segments of the region itself, in map-wide pixels, and cut off at the edges of the region.
+		# the lines on a region's far edges belong to the next region over, unless there isn't one.
+		w = self.world
+		if w.cache_dirty:
+			w.recalculate_cache()
+		ox, oy = self.offset
+		x1, y1, x2, y2 = self.region
+		map_w, map_h = self.map_size
+		out = []
+		for i, (dx, dy) in enumerate(world.DIRECTIONS):
+			if dx:
+				dep_lo, dep_hi, dep_last, ind_lo, ind_hi, dep_off, ind_off = x1 * self.cw, x2 * self.cw, x2 == map_w, y1 * self.ch, y2 * self.ch, ox, oy
+			else:
+				dep_lo, dep_hi, dep_last, ind_lo, ind_hi, dep_off, ind_off = y1 * self.ch, y2 * self.ch, y2 == map_h, x1 * self.cw, x2 * self.cw, oy, ox
+			clipped = []
+			for dep, start, end in w.segments[i]:
+				dep, start, end = dep + dep_off, max(start + ind_off, ind_lo), min(end + ind_off, ind_hi)
+				if (dep_lo <= dep < dep_hi or (dep_last and dep == dep_hi)) and start < end:
+					clipped.append((dep, start, end))
+			out.append(clipped)
+		return out
+
+
+def _serve(conn, args):
+	shard = Shard(*args)
+	while True:
+		method, method_args = conn.recv()
+		if method is None:
+			break
+		conn.send(getattr(shard, method)(*method_args))
+	conn.close()
+
+
+class ShardedWorld:
+	# splits a map into rectangular shards, each simulated by its own World and timer heap in a worker process. the
+	# shards run in lockstep on virtual clocks, and entities that cross into another shard's region get handed over
+	# at the end of each step. entities are created through kinds: names for "module.attribute" references to
+	# callables taking (x, y) and returning an Entity with a PositionVelocity.
+	#
+	# only the icons of the template map are used, and entities only collide with entities in the same shard.
+	def __init__(self, template, kinds, columns, rows, halo=HALO_CELLS, step=STEP, start=0.0, context=None):
+		assert halo >= 1, "shards need a halo, to keep the edges of their Worlds out of their regions"
+		self.template = template  # holds the whole map, for rendering
+		self.kinds = kinds
+		self.step = step
+		self.now = start
+		self.next_id = 0
+		self.cw, self.ch = template.tileset.cell_size()
+		self.regions = plan_shards(template.width, template.height, columns, rows)
+		self.prototypes = dict((name, _resolve(ref)(0, 0)) for name, ref in kinds.items())
+		tileset = template.tileset
+		tileset_args = tileset.image, tileset.w, tileset.h, tileset.cw, tileset.ch
+		ctx = multiprocessing.get_context(context)
+		self.connections = []
+		self.processes = []
+		for region in self.regions:
+			x1, y1, x2, y2 = region
+			bounds = max(x1 - halo, 0), max(y1 - halo, 0), min(x2 + halo, template.width), min(y2 + halo, template.height)
+			bx1, by1, bx2, by2 = bounds
+			cells = array.array("H")
+			for x in range(bx1, bx2):
+				cells.extend(template.cells[x * template.height + by1:x * template.height + by2])
+			map_size = template.width, template.height
+			args = region, bounds, map_size, cells, template.icons, list(template.solid_tiles), tileset_args, kinds, start
+			conn, child_conn = ctx.Pipe()
+			process = ctx.Process(target=_serve, args=(child_conn, args), daemon=True)
+			process.start()
+			self.connections.append(conn)
+			self.processes.append(process)
+
+	def _call(self, method, *args):
+		# sends the call to every shard first, so that they all work on it at the same time
+		for conn in self.connections:
+			conn.send((method, args))
+		return [conn.recv() for conn in self.connections]
+
+	def shard_at(self, x, y):
+		cx = min(max(int(x // self.cw), 0), self.template.width - 1)
+		cy = min(max(int(y // self.ch), 0), self.template.height - 1)
+		for i, (x1, y1, x2, y2) in enumerate(self.regions):
+			if x1 <= cx < x2 and y1 <= cy < y2:
+				return i
+
+	def _hand_over(self, records):
+		by_shard = {}
+		for record in records:
+			x, y, vx, vy, start_time = record[2]
+			x, y = x + vx * (self.now - start_time), y + vy * (self.now - start_time)
+			by_shard.setdefault(self.shard_at(x, y), []).append(record)
+		for i, shard_records in by_shard.items():
+			self.connections[i].send(("add", (shard_records,)))
+		for i in by_shard:
+			self.connections[i].recv()
+
+	def add_entity(self, kind, x, y, vx=0, vy=0):
+		eid = self.next_id
+		self.next_id += 1
+		self._hand_over([(eid, kind, (x, y, vx, vy, self.now))])
+		return eid
+
+	def run_until(self, mono):
+		while self.now < mono:
+			self.now = min(mono, self.now + self.step)
+			leaving = []
+			for records in self._call("run_until", self.now):
+				leaving += records
+			self._hand_over(leaving)
+
+	def run_for(self, seconds):
+		self.run_until(self.now + seconds)
+
+	def states(self):
+		# entity id -> (kind, pos_vel_time), in map-wide pixels
+		out = {}
+		for records in self._call("states"):
+			for eid, kind, pos_vel_time in records:
+				out[eid] = kind, pos_vel_time
+		return out
+
+	def set_icon(self, x, y, icon):
+		self.template.update_icon_only(x, y, icon)
+		self._call("set_icon", x, y, icon)
+
+	def segments(self):
+		# the merged wall segments of all of the shards, in the same form as World.segments
+		merged = [[], [], [], []]
+		for shard_segments in self._call("segments"):
+			for i, segments in enumerate(shard_segments):
+				merged[i] += segments
+		return [_merge_segments(segments) for segments in merged]
+
+	def render(self, renderer, rx, ry):
+		renderer.begin_batch()
+		self.template.render_tiles(renderer, rx, ry)
+		for kind, pos_vel_time in self.states().values():
+			proxy = _Proxy(pos_vel_time)
+			for render in self.prototypes[kind].renderers:
+				if render(renderer, proxy, rx, ry, self.now):
+					break
+		renderer.end_batch()
+
+	def close(self):
+		for conn in self.connections:
+			conn.send((None, ()))
+		for process in self.processes:
+			process.join()
+		self.connections, self.processes = [], []
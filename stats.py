@@ -0,0 +1,150 @@
+__author__ = 'colby'
+
+import bisect
+import collections
+import functools
+import itertools
+import time
+
+ROLLING_WINDOW = 1000  # samples that a histogram remembers
+TIME_EDGES = [1e-6 * 2 ** (i / 2.0) for i in range(48)]  # bucket bounds for durations, from 1us up to about 12s
+COUNT_EDGES = [2 ** i for i in range(25)]  # bucket bounds for sizes and counts
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram:
+	# a histogram of the last `window` samples: the oldest sample leaves its bucket as each new one comes in
+	def __init__(self, edges=TIME_EDGES, window=ROLLING_WINDOW):
+		self.edges = edges
+		self.counts = [0] * (len(edges) + 1)
+		self.samples = collections.deque()
+		self.window = window
+		self.total = 0
+
+	def add(self, value):
+		samples = self.samples
+		if len(samples) >= self.window:
+			old = samples.popleft()
+			self.counts[bisect.bisect_left(self.edges, old)] -= 1
+			self.total -= old
+		samples.append(value)
+		self.counts[bisect.bisect_left(self.edges, value)] += 1
+		self.total += value
+
+	def clear(self):
+		self.counts = [0] * (len(self.edges) + 1)
+		self.samples.clear()
+		self.total = 0
+
+	def recent(self, count):
+		# the last count samples, oldest first
+		return list(itertools.islice(reversed(self.samples), count))[::-1]
+
+	def percentile(self, p):
+		# the upper bound of the bucket that holds the pth percentile (or the actual maximum, if that's lower)
+		if not self.samples:
+			return None
+		remaining = len(self.samples) * p / 100.0
+		for i, count in enumerate(self.counts):
+			remaining -= count
+			if remaining <= 0 and count:
+				break
+		top = max(self.samples)
+		return min(self.edges[i], top) if i < len(self.edges) else top
+
+	def buckets(self):
+		# (upper bound, count) for each bucket that has anything in it; the last bound is infinite
+		bounds = self.edges + [float("inf")]
+		return [(bounds[i], count) for i, count in enumerate(self.counts) if count]
+
+	def summary(self):
+		count = len(self.samples)
+		out = {"count": count, "mean": self.total / count if count else None, "max": max(self.samples) if count else None}
+		for p in PERCENTILES:
+			out["p%d" % p] = self.percentile(p)
+		out["buckets"] = self.buckets()
+		return out
+
+
+def callback_name(cb):
+	while isinstance(cb, functools.partial):
+		cb = cb.func
+	return getattr(cb, "__qualname__", None) or type(cb).__qualname__
+
+
+class Stats:
+	# a set of named rolling histograms. nothing records into one of these unless it's been explicitly hooked up
+	# (see EventLoop.instrument and timed), so leaving instrumentation off costs nothing.
+	def __init__(self, window=ROLLING_WINDOW):
+		self.window = window
+		self.histograms = {}
+
+	def histogram(self, name, edges=TIME_EDGES):
+		hist = self.histograms.get(name)
+		if hist is None:
+			hist = self.histograms[name] = Histogram(edges, self.window)
+		return hist
+
+	def add(self, name, value):
+		self.histogram(name).add(value)
+
+	def names(self, prefix=""):
+		return sorted(name for name in self.histograms if name.startswith(prefix))
+
+	def query(self, prefix=""):
+		# name -> summary, for every histogram whose name starts with prefix
+		return dict((name, self.histograms[name].summary()) for name in self.names(prefix))
+
+	def clear(self):
+		for hist in self.histograms.values():
+			hist.clear()
+
+	def timed(self, obj, attr, name=None):
+		# shadows a method of obj with a version that records its durations, until untimed gets called
+		method = getattr(obj, attr)
+		hist = self.histogram(name or callback_name(method))
+
+		@functools.wraps(method)
+		def wrapper(*args, **kwargs):
+			start = time.perf_counter()
+			try:
+				return method(*args, **kwargs)
+			finally:
+				hist.add(time.perf_counter() - start)
+		setattr(obj, attr, wrapper)
+
+	@staticmethod
+	def untimed(obj, attr):
+		delattr(obj, attr)
+
+	def report(self, prefix=""):
+		# a plain-text table of the summaries, with durations in milliseconds
+		lines = ["%-48s %7s %10s %10s %10s %10s" % ("name", "count", "mean", "p50", "p99", "max")]
+		for name, summary in sorted(self.query(prefix).items()):
+			scale = 1000 if self.histograms[name].edges is TIME_EDGES else 1
+			values = [summary[key] * scale if summary[key] is not None else float("nan") for key in ("mean", "p50", "p99", "max")]
+			lines.append("%-48s %7d %10.3f %10.3f %10.3f %10.3f" % tuple([name, summary["count"]] + values))
+		return "\n".join(lines)
+
+
+class Overlay:
+	# a frame time graph: one column per recent frame, with the phases stacked on top of each other
+	def __init__(self, stats, phases, width=200, pixels_per_second=2000):
+		self.stats = stats
+		self.phases = phases  # list of (histogram name, color)
+		self.width = width
+		self.scale = pixels_per_second
+
+	def render(self, renderer, x, y):  # (x, y) is the lower-left corner
+		for budget in (1 / 60.0, 1 / 30.0):
+			line_y = y - budget * self.scale
+			renderer.draw_line(x, line_y, x + self.width, line_y, (128, 128, 128))
+		columns = [self.stats.histogram(name).recent(self.width) for name, _ in self.phases]
+		frames = min(len(column) for column in columns)
+		for i in range(frames):
+			base = y
+			for column, (_, color) in zip(columns, self.phases):
+				top = base - column[len(column) - frames + i] * self.scale
+				if top < base:
+					renderer.draw_line(x + i, base, x + i, top, color)
+				base = top
@@ -1,10 +1,18 @@
 __author__ = 'colby'
 
+import dispatch
+
 
 class Tile:
 	valid_messages = ("on_click", "on_event")
-
-	def __init__(self, *components):
+	structural = ("components", "handlers", "update_handlers", "x", "y", "world", "tile_type")
+
+	def __init__(self, *components, tile_type=None, handlers=None):
+		object.__setattr__(self, "tile_type", tile_type)
+		object.__setattr__(self, "world", None)
+		handlers, update_handlers = handlers if handlers is not None else bind_handlers(components)
+		object.__setattr__(self, "handlers", handlers)
+		object.__setattr__(self, "update_handlers", update_handlers)
 		self.components = components
 		self.x = None
 		self.y = None
@@ -21,22 +29,35 @@ class Tile:
 		self.x = self.y = self.world = None
 
 	def post_event(self, name, *args):
-		for component in self.components:
-			if hasattr(component, name):
-				out = getattr(component, name)(self, *args)
-				if out:
-					return out
-
-	def __getattr__(self, name):
-		if name in Tile.valid_messages:
-			return lambda *args: self.post_event(name, *args)
-		if name == "now":
-			return self.world.time_provider.now()
-		raise AttributeError("%r object has no attribute %r" % (self.__class__, name))
+		for handler in self.handlers.get(name, ()):
+			out = handler(self, *args)
+			if out:
+				return out
+
+	def on_click(self, *args):
+		return self.post_event("on_click", *args)
+
+	def on_event(self, *args):
+		return self.post_event("on_event", *args)
+
+	@property
+	def now(self):
+		return self.world.time_provider.now()
 
 	def __setattr__(self, name, value):
 		object.__setattr__(self, name, value)
-		self.post_event("on_update_" + name)
+		for handler in self.update_handlers.get(name, ()):
+			if handler(self):
+				break
+		if self.tile_type is not None and self.world is not None:
+			self.world.tile_changed(self)
+
+	def get_state(self):
+		return dict((k, v) for k, v in self.__dict__.items() if k not in Tile.structural)
+
+	def is_default_state(self):
+		icon, state = self.tile_type.default_state()
+		return self.get_icon() == icon and self.get_state() == state
 
 	def set_icon(self, icon):
 		self.world.update_icon_only(self.x, self.y, icon)
@@ -53,12 +74,49 @@ class SimpleIcon:
 		ent.set_icon(self.icon)
 
 
+def bind_handlers(components):
+	# returns the handlers per message, and the handlers for "on_update_" + name per attribute name
+	handlers = dispatch.bind(dispatch.build_table(components), components)
+	updates = {}
+	for name, bound in handlers.items():
+		if name.startswith("on_update_"):
+			updates[name[len("on_update_"):]] = bound
+	return handlers, updates
+
+
+class _StateRecorder:
+	# stands in for a world while a prototype tile gets added, to find out what state new tiles start out in
+	def __init__(self):
+		self.icon = None
+
+	def update_icon_only(self, x, y, icon):
+		self.icon = icon
+
+	def get_icon_only(self, x, y):
+		return self.icon
+
+	def tile_changed(self, ent):
+		pass
+
+
 class TileType:
+	# a TileType can also be placed into a World directly, as a flyweight for a tile of this type in its default state
 	def __init__(self, *components):
 		self.components = components
+		self.default = None
+		# the components are shared between all tiles of this type, so the bound handlers can be too
+		self.handlers = bind_handlers(components)
 
 	def __call__(self):
-		return Tile(*self.components)
+		return Tile(*self.components, tile_type=self, handlers=self.handlers)
+
+	def default_state(self):  # returns (icon, state)
+		if self.default is None:
+			recorder = _StateRecorder()
+			prototype = Tile(*self.components)
+			prototype.add(recorder, 0, 0)
+			self.default = recorder.icon, prototype.get_state()
+		return self.default
 
 
 def Simple(x, y):
@@ -0,0 +1,238 @@
+__author__ = 'colby'
+
+import asyncio
+import functools
+import heapq
+import time
+import stats
+
+
+class Timer:
+	# handle for a pending timer. cancelling only marks the heap entry as dead; the loop drops it later.
+	__slots__ = ("loop", "mono", "entry", "cb", "args")
+
+	def __init__(self, loop, mono, cb, args):
+		self.loop = loop
+		self.mono = mono
+		self.entry = None
+		self.cb = cb
+		self.args = args
+
+	def when(self):
+		return self.mono
+
+	def active(self):
+		return self.entry is not None
+
+	def cancel(self):
+		if self.entry is not None:
+			entry = self.entry
+			entry[2] = None
+			self.entry = None
+			self.loop._on_cancel(entry)
+
+	def reschedule(self, mono):
+		self.cancel()
+		self.mono = mono
+		self.loop._push(self)
+
+	def reschedule_in(self, timeout):
+		self.reschedule(self.loop.now() + timeout)
+
+
+class TimerLoop:
+	# the timer half of the event loop, which doesn't need SDL. subclasses decide what time it is: see clock.
+	COMPACT_MIN = 64  # don't bother compacting heaps smaller than this
+	COMPACT_RATIO = 0.5  # compact once more than this share of the heap is dead
+
+	def __init__(self, start):
+		self.timers = []  # heap of [mono, entryid, timer], where timer is None once cancelled
+		self.dead_timers = 0
+		self.entryid = 0
+		self._now = start
+		self.stats = None
+
+	def clock(self):
+		# the time it actually is, as opposed to now, which is the time of the timer currently running
+		raise NotImplementedError()
+
+	def now(self):
+		return self._now
+
+	def on_next(self, cb, *args):
+		return self.add_timer(0, cb, *args)
+
+	def _push(self, timer):
+		if timer.mono == float("inf"):
+			return  # don't even bother
+		timer.entry = [timer.mono, self.entryid, timer]
+		heapq.heappush(self.timers, timer.entry)
+		self.entryid += 1
+
+	def _on_cancel(self, entry):
+		self.dead_timers += 1
+		if self.dead_timers >= TimerLoop.COMPACT_MIN and self.dead_timers > len(self.timers) * TimerLoop.COMPACT_RATIO:
+			self.timers = [entry for entry in self.timers if entry[2] is not None]
+			heapq.heapify(self.timers)
+			self.dead_timers = 0
+
+	def add_timer_at(self, mono, cb, *args):
+		timer = Timer(self, mono, cb, args)
+		self._push(timer)
+		return timer
+
+	def add_timer(self, timeout, cb, *args):
+		return self.add_timer_at(self.now() + timeout, cb, *args)
+
+	def add_interval(self, interval, cb, *args):
+		@functools.wraps(cb)
+		def wrap_cb():
+			timer.reschedule_in(interval)
+			cb(*args)
+		timer = self.add_timer(interval, wrap_cb)
+		return timer
+
+	def next_deadline(self):
+		timers = self.timers
+		while timers and timers[0][2] is None:
+			heapq.heappop(timers)
+			self.dead_timers -= 1
+		return timers[0][0] if timers else float("inf")
+
+	def run_timers(self, now):  # runs everything due by now, and returns whether anything ran
+		timers = self.timers
+		ran = False
+		while timers and timers[0][0] <= now:
+			mono, _, timer = heapq.heappop(timers)
+			if timer is None:
+				self.dead_timers -= 1
+				continue
+			timer.entry = None
+			self._now = mono
+			timer.cb(*timer.args)
+			ran = True
+			timers = self.timers  # might have been compacted by the callback
+		self._now = now
+		return ran
+
+	def instrument(self, stats):
+		# swaps in a version of run_timers that records into stats; the plain one never checks for it
+		self.stats = stats
+		self.run_timers = self._run_timers_instrumented
+
+	def uninstrument(self):
+		if self.stats is not None:
+			del self.run_timers
+			self.stats = None
+
+	def _run_timers_instrumented(self, now):
+		loop_stats = self.stats
+		callback_time, lateness = loop_stats.histogram("timer.callback"), loop_stats.histogram("timer.lateness")
+		loop_stats.histogram("timer.heap", stats.COUNT_EDGES).add(len(self.timers))
+		loop_stats.histogram("timer.dead", stats.COUNT_EDGES).add(self.dead_timers)
+		timers = self.timers
+		ran = False
+		while timers and timers[0][0] <= now:
+			mono, _, timer = heapq.heappop(timers)
+			if timer is None:
+				self.dead_timers -= 1
+				continue
+			timer.entry = None
+			self._now = mono
+			lateness.add(self.clock() - mono)
+			start = time.perf_counter()
+			timer.cb(*timer.args)
+			elapsed = time.perf_counter() - start
+			callback_time.add(elapsed)
+			loop_stats.add("callback." + stats.callback_name(timer.cb), elapsed)
+			ran = True
+			timers = self.timers
+		self._now = now
+		return ran
+
+
+class VirtualClock(TimerLoop):
+	# a timer loop where time only passes when asked to, and then jumps straight from one deadline to the next, so
+	# that hours of activity can be simulated as fast as the callbacks themselves run.
+	def __init__(self, start=0.0):
+		TimerLoop.__init__(self, start)
+
+	def clock(self):
+		return self._now
+
+	def step(self):
+		# jumps to the next deadline and runs everything that's due then; returns False if nothing is pending
+		deadline = self.next_deadline()
+		if deadline == float("inf"):
+			return False
+		self.run_timers(deadline)
+		return True
+
+	def run_until(self, mono):
+		self.run_timers(mono)
+		self._now = max(self._now, mono)
+
+	def run_for(self, seconds):
+		self.run_until(self._now + seconds)
+
+
+class AsyncioTimerLoop(TimerLoop):
+	# a timer loop that hands its timers to an asyncio event loop instead of keeping a heap of its own: add_timer_at
+	# becomes call_at, and anything that's already due (like on_next) becomes call_soon. that way, timers can share the
+	# process with asyncio networking, subprocesses and so on, and they wake up as precisely as asyncio's selector does.
+	# asyncio's clock is time.monotonic, same as EventLoop's.
+	def __init__(self, aio=None):
+		# without an asyncio loop to use, this has to be made from inside of the one that's running
+		self.aio = aio if aio is not None else asyncio.get_running_loop()
+		TimerLoop.__init__(self, self.aio.time())
+		self._now = None  # only set while a timer runs
+		self.activity = asyncio.Event()  # set whenever a timer runs, for whoever wants to know that something happened
+
+	def clock(self):
+		return self.aio.time()
+
+	def now(self):
+		# inside of a timer, it's the timer's deadline; otherwise, it's whatever time it actually is
+		return self._now if self._now is not None else self.aio.time()
+
+	def _push(self, timer):
+		if timer.mono == float("inf"):
+			return
+		# like the heap entries, [mono, handle, timer], where timer is None once cancelled
+		entry = timer.entry = [timer.mono, None, timer]
+		if timer.mono <= self.aio.time():
+			entry[1] = self.aio.call_soon(self._fire, entry)
+		else:
+			entry[1] = self.aio.call_at(timer.mono, self._fire, entry)
+
+	def _on_cancel(self, entry):
+		entry[1].cancel()
+
+	def _fire(self, entry):
+		mono, _, timer = entry
+		timer.entry = None
+		self._now = mono
+		try:
+			timer.cb(*timer.args)
+		finally:
+			self._now = None
+		self.activity.set()
+
+	def instrument(self, stats):
+		# asyncio already captured _fire for the timers that are pending, so only the ones added from now on get recorded
+		self.stats = stats
+		self._fire = self._fire_instrumented
+
+	def uninstrument(self):
+		if self.stats is not None:
+			del self._fire
+			self.stats = None
+
+	def _fire_instrumented(self, entry):
+		mono, _, timer = entry
+		self.stats.add("timer.lateness", self.clock() - mono)
+		start = time.perf_counter()
+		AsyncioTimerLoop._fire(self, entry)
+		elapsed = time.perf_counter() - start
+		self.stats.add("timer.callback", elapsed)
+		self.stats.add("callback." + stats.callback_name(timer.cb), elapsed)
@@ -1,9 +1,13 @@
 __author__ = 'colby'
 
+import array
 import bisect
 import math
+import weakref
 import tile
 import sdle
+import broadphase
+import pathfind
 
 
 class Tileset:
@@ -43,74 +47,313 @@ IDX_UP = DIRECTIONS.index(DIR_UP)
 IDX_DOWN = DIRECTIONS.index(DIR_DOWN)
 IDX_LEFT = DIRECTIONS.index(DIR_LEFT)
 IDX_RIGHT = DIRECTIONS.index(DIR_RIGHT)
+_BIT_CHARS = bytes.maketrans(b"\x00\x01", b"01")
+
+
+def _bit_runs(mask):
+	# yields (start, end) for each run of set bits in mask, lowest first
+	while mask:
+		low = mask & -mask
+		filled = mask + low  # carries all the way through the lowest run
+		yield low.bit_length() - 1, (filled & -filled).bit_length() - 1
+		mask &= filled
+
+
 DIRECTION_COLORS = [(0, 255, 0), (0, 0, 255), (255, 0, 0), (255, 255, 0)]
+BROADPHASE_CELLS = 4  # width of a broadphase bucket, in map cells
+CHUNK_CELLS = 32  # width of a pre-rendered chunk of the tile layer, in map cells
+CHUNK_CACHE_LIMIT = 64  # beyond this many chunks, the ones furthest from the screen get released
 
 
 class World:
-	def __init__(self, default_map, tileset, solid_tiles, time_provider):
-		self.tileset = tileset
-		self.time_provider = time_provider
+	def __init__(self, default_map, tileset, solid_tiles, time_provider, ray_caster=None):
 		assert default_map and default_map[0], "map must not be empty!"
 		rlen = len(default_map[0])
 		for column in default_map:
 			assert len(column) == rlen, "mismatched column lengths!"
-		self.layer = [list(column) for column in default_map]
+		self._setup(len(default_map), rlen, None, tileset, solid_tiles, time_provider, ray_caster)
+		initial_tiles = []
+		for x, column in enumerate(default_map):
+			for y, cell in enumerate(column):
+				if isinstance(cell, (tile.Tile, tile.TileType)):
+					initial_tiles.append((x, y, cell))
+				else:
+					self.cells[x * self.height + y] = self.intern_icon(cell)
+		self.rebuild_solidity()
+		for x, y, cell in initial_tiles:
+			self[x, y] = cell
+
+	@classmethod
+	def from_cells(cls, width, height, icons, cells, tileset, solid_tiles, time_provider, ray_caster=None):
+		# builds a world straight from an array of icon ids (column by column, like self.cells), where icons[0] is None
+		assert icons[0] is None and len(cells) == width * height
+		self = cls.__new__(cls)
+		self._setup(width, height, cells, tileset, solid_tiles, time_provider, ray_caster)
+		for icon in icons[1:]:
+			self.icon_ids.setdefault(icon, len(self.icons))
+			self.icons.append(icon)
+			self.solid_flags.append(icon in self.solid_tiles)
+		self.rebuild_solidity()
+		return self
+
+	def _setup(self, width, height, cells, tileset, solid_tiles, time_provider, ray_caster):
+		self.tileset = tileset
+		self.time_provider = time_provider
+		self.ray_caster = ray_caster if ray_caster is not None else SegmentRayCaster()
+		self.width, self.height = width, height
+		# cells hold interned icon ids, column by column; id 0 is reserved for None
+		self.icons = [None]
+		self.icon_ids = {None: 0}
+		self.solid_flags = bytearray(1)  # per icon id
+		self.cells = cells if cells is not None else array.array("H", bytes(2 * width * height))
+		# bit y of solid_columns[x] and bit x of solid_rows[y] are set when cell (x, y) is solid
+		self.solid_columns = [0] * self.width
+		self.solid_rows = [0] * self.height
+		# either a Tile, or the TileType of a tile that's still in its default state (a flyweight)
 		self.tiles = {}
+		# tiles that went back to being flyweights, but might still be referenced from elsewhere
+		self.released_tiles = weakref.WeakValueDictionary()
+		self.pending_release = set()
 		self.segments = [[], [], [], []]
-		self.solid_tiles = solid_tiles
+		# per direction: the sorted grid lines (in pixels) that have segments, and for each one, the sorted starts and
+		# ends of its segments, so that a ray only has to look at the lines it crosses.
+		self.segment_lines = [[], [], [], []]
+		self.segment_index = [{}, {}, {}, {}]
+		self.solid_tiles = set(solid_tiles)
 		self.cache_dirty = True
+		self.dirty_cells = None  # None means that everything needs to be rebuilt
 		self.entities = []
-		for x, column in enumerate(self.layer):
-			for y, cell in enumerate(column):
-				self[x,y] = cell
+		self.broadphase = broadphase.UniformGrid(BROADPHASE_CELLS * max(tileset.cell_size()))
+		self.chunks = {}  # (chunk_x, chunk_y) -> layer holding the pre-rendered tiles of that chunk
+		self.chunk_renderer = None
+		self.redraw_cells = set()
+		self.pathfinder = None  # see build_pathfinder
+		self.entity_store = None
+		self.loose_entities = self.entities  # the ones that the entity store doesn't draw (all of them, without one)
+
+	def intern_icon(self, icon):
+		icon_id = self.icon_ids.get(icon)
+		if icon_id is None:
+			icon_id = len(self.icons)
+			assert icon_id < 65536, "too many distinct icons!"
+			self.icons.append(icon)
+			self.icon_ids[icon] = icon_id
+			self.solid_flags.append(icon in self.solid_tiles)
+		return icon_id
+
+	def rebuild_solidity(self):
+		# builds the solidity bitmaps from scratch, a whole column or row at a time
+		h = self.height
+		bits = bytes(map(self.solid_flags.__getitem__, self.cells)).translate(_BIT_CHARS)
+		self.solid_columns = [int(bits[x * h:(x + 1) * h][::-1], 2) for x in range(self.width)]
+		self.solid_rows = [int(bits[y::h][::-1], 2) for y in range(h)]
+
+	def _set_icon(self, x, y, icon):
+		icon_id = self.intern_icon(icon)
+		self.cells[x * self.height + y] = icon_id
+		if self.solid_flags[icon_id]:
+			self.solid_columns[x] |= 1 << y
+			self.solid_rows[y] |= 1 << x
+		else:
+			self.solid_columns[x] &= ~(1 << y)
+			self.solid_rows[y] &= ~(1 << x)
 
 	def add_entity(self, ent):
 		self.entities.append(ent)
 		ent.world = self
 		ent.on_add(self)
+		if self.loose_entities is not self.entities and not self.entity_store.draws(ent):
+			self.loose_entities.append(ent)
 		return ent
 
+	def remove_entity(self, ent):
+		self.entities.remove(ent)
+		if self.loose_entities is not self.entities and ent in self.loose_entities:
+			self.loose_entities.remove(ent)
+		ent.on_remove(self)
+		ent.world = None
+
+	def set_entity_store(self, store):
+		# from now on, the store draws the entities that it holds, all at once
+		self.entity_store = store
+		self.loose_entities = [ent for ent in self.entities if not store.draws(ent)]
+
 	def __getitem__(self, item):
 		if item in self.tiles:
-			return self.tiles[item]
+			value = self.tiles[item]
+			if isinstance(value, tile.TileType):
+				value = self._materialize(item, value)
+			return value
 		x, y = item
-		return self.layer[x][y]
+		return self.icons[self.cells[x * self.height + y]]
 
 	def __setitem__(self, item, value):
 		x, y = item
 		if item in self.tiles:
-			self.tiles[item].remove()
-			del self.tiles[item]
+			old = self.tiles.pop(item)
+			old = old if isinstance(old, tile.Tile) else self.released_tiles.get(item)
+			self.released_tiles.pop(item, None)
+			if old is not None:
+				old.remove()
 		if isinstance(value, tile.Tile):
 			self.tiles[item] = value
-			self.layer[x][y] = None
+			self._set_icon(x, y, None)
 			value.add(self, x, y)
-			assert self.layer[x][y] is not None, "Tile didn't add an icon!"
+			assert self.get_icon_only(x, y) is not None, "Tile didn't add an icon!"
+		elif isinstance(value, tile.TileType):
+			# stateful tiles only turn into real Tiles once something actually looks at them
+			self.tiles[item] = value
+			self._set_icon(x, y, value.default_state()[0])
+		else:
+			self._set_icon(x, y, value)
+		self.dirty_cache(x, y)
+		self.redraw_cell(x, y)
+
+	def _materialize(self, item, tile_type):
+		value = self.released_tiles.pop(item, None)
+		if value is not None:
+			self.tiles[item] = value
 		else:
-			self.layer[x][y] = value
-		self.dirty_cache()
+			x, y = item
+			value = self.tiles[item] = tile_type()
+			value.add(self, x, y)
+		return value
+
+	def tile_changed(self, value):
+		item = value.x, value.y
+		if self.tiles.get(item) is not value:
+			if self.released_tiles.get(item) is not value:
+				return
+			# someone held on to it after it got released, and now it's changing again
+			del self.released_tiles[item]
+			self.tiles[item] = value
+		if not self.pending_release:
+			self.time_provider.on_next(self._release_default_tiles)
+		self.pending_release.add(item)
+
+	def _release_default_tiles(self):
+		for item in self.pending_release:
+			value = self.tiles.get(item)
+			if isinstance(value, tile.Tile) and value.tile_type is not None and value.is_default_state():
+				self.released_tiles[item] = value
+				self.tiles[item] = value.tile_type
+		self.pending_release = set()
 
 	def update_icon_only(self, x, y, value):
-		self.layer[x][y] = value
-		self.dirty_cache()
+		if self.get_icon_only(x, y) == value:
+			return
+		self._set_icon(x, y, value)
+		self.dirty_cache(x, y)
+		self.redraw_cell(x, y)
+
+	def redraw_cell(self, x, y):
+		if (x // CHUNK_CELLS, y // CHUNK_CELLS) in self.chunks:
+			self.redraw_cells.add((x, y))
 
-	def dirty_cache(self):
+	def dirty_cache(self, x=None, y=None):
+		if x is None:
+			self.dirty_cells = None
+		elif self.dirty_cells is not None:
+			self.dirty_cells.add((x, y))
+		if self.pathfinder is not None:
+			self.pathfinder.invalidate(x, y)
 		if not self.cache_dirty:
 			self.time_provider.on_next(self.on_update_map)
 			self.cache_dirty = True
 
+	def build_pathfinder(self):
+		# builds the whole abstract graph right away, so that the first path doesn't have to wait for it; after this,
+		# map changes only rebuild the clusters that they touch. worlds that never get this call build it on first use.
+		self.get_pathfinder().refresh()
+
+	def get_pathfinder(self):
+		if self.pathfinder is None:
+			self.pathfinder = pathfind.Pathfinder(self)
+		return self.pathfinder
+
 	def on_update_map(self):
-		assert self.cache_dirty
+		# by now, something might have already rebuilt the cache (like a ray cast from a timer that was due at the
+		# same time, or someone reading the segments); the entities still need to hear about the change.
 		for ent in self.entities:
 			ent.on_update_map()
 
+	def is_animating(self):
+		for ent in self.entities:
+			vx, vy = ent.get_velocity()
+			if vx or vy:
+				return True
+		return False
+
 	def get_icon_only(self, x, y):
-		return self.layer[x][y]
+		return self.icons[self.cells[x * self.height + y]]
+
+	def release_chunks(self):
+		for layer in self.chunks.values():
+			self.chunk_renderer.destroy_layer(layer)
+		self.chunks = {}
+		self.redraw_cells = set()
+
+	def _draw_cells(self, renderer, chunk_x, chunk_y, cells):
+		cw, ch = self.tileset.cell_size()
+		ox, oy = chunk_x * CHUNK_CELLS, chunk_y * CHUNK_CELLS
+		# clear everything first, so that the tiles themselves can all go out in one batch
+		for x, y in cells:
+			renderer.clear_rect(((x - ox) * cw, (y - oy) * ch, cw, ch))
+		for x, y in cells:
+			self.tileset.render(renderer, self.get_icon_only(x, y), cells_x=x - ox, cells_y=y - oy)
+
+	def _get_chunk(self, renderer, chunk_x, chunk_y):
+		layer = self.chunks.get((chunk_x, chunk_y))
+		if layer is None:
+			cw, ch = self.tileset.cell_size()
+			xs = range(chunk_x * CHUNK_CELLS, min((chunk_x + 1) * CHUNK_CELLS, self.width))
+			ys = range(chunk_y * CHUNK_CELLS, min((chunk_y + 1) * CHUNK_CELLS, self.height))
+			layer = self.chunks[chunk_x, chunk_y] = renderer.create_layer(len(xs) * cw, len(ys) * ch)
+			renderer.begin_layer(layer)
+			self._draw_cells(renderer, chunk_x, chunk_y, [(x, y) for x in xs for y in ys])
+			renderer.end_layer()
+		return layer
+
+	def render_tiles(self, renderer, rx, ry):
+		# the tiles only get drawn once into the chunk layers, after which only changed cells get redrawn
+		if self.chunk_renderer is not renderer:
+			if self.chunk_renderer is not None:
+				self.release_chunks()
+			self.chunk_renderer = renderer
+		if self.redraw_cells:
+			by_chunk = {}
+			for x, y in self.redraw_cells:
+				by_chunk.setdefault((x // CHUNK_CELLS, y // CHUNK_CELLS), []).append((x, y))
+			self.redraw_cells = set()
+			for (chunk_x, chunk_y), cells in by_chunk.items():
+				renderer.begin_layer(self.chunks[chunk_x, chunk_y])
+				self._draw_cells(renderer, chunk_x, chunk_y, cells)
+				renderer.end_layer()
+		cw, ch = self.tileset.cell_size()
+		xs, ys = self.visible_cells(renderer, rx, ry)
+		chunk_xs = range(xs.start // CHUNK_CELLS, (xs.stop + CHUNK_CELLS - 1) // CHUNK_CELLS)
+		chunk_ys = range(ys.start // CHUNK_CELLS, (ys.stop + CHUNK_CELLS - 1) // CHUNK_CELLS)
+		for chunk_x in chunk_xs:
+			for chunk_y in chunk_ys:
+				layer = self._get_chunk(renderer, chunk_x, chunk_y)
+				renderer.draw_layer(layer, rx + chunk_x * CHUNK_CELLS * cw, ry + chunk_y * CHUNK_CELLS * ch)
+		if len(self.chunks) > CHUNK_CACHE_LIMIT:
+			center_x, center_y = (chunk_xs.start + chunk_xs.stop) / 2, (chunk_ys.start + chunk_ys.stop) / 2
+			by_distance = sorted(self.chunks, key=lambda chunk: abs(chunk[0] - center_x) + abs(chunk[1] - center_y))
+			for chunk in by_distance[CHUNK_CACHE_LIMIT:]:
+				renderer.destroy_layer(self.chunks.pop(chunk))
+
+	def visible_cells(self, renderer, rx, ry):
+		# the ranges of cells that are at least partially on screen when drawn at (rx, ry)
+		cw, ch = self.tileset.cell_size()
+		ww, wh = renderer.get_size()
+		xs = range(max(int(-rx // cw), 0), min(int(math.ceil((ww - rx) / cw)), self.width))
+		ys = range(max(int(-ry // ch), 0), min(int(math.ceil((wh - ry) / ch)), self.height))
+		return xs, ys
 
 	def render(self, renderer, rx, ry):
-		for x, column in enumerate(self.layer):
-			for y, cell in enumerate(column):
-				self.tileset.render(renderer, cell, base_x=rx, base_y=ry, cells_x=x, cells_y=y)
+		renderer.begin_batch()
+		self.render_tiles(renderer, rx, ry)
 		# these are subtly different, which is why they aren't refactored yet
 		# also, they're just debugging
 		if False:
@@ -124,95 +367,312 @@ class World:
 				renderer.draw_line(rx + x, ry + y1, rx + x, ry + y2, (255, 255, 0))
 		# end of debugging
 		now = self.time_provider.now()
-		for ent in self.entities:
-			ent.render(renderer, rx, ry, now)
+		ww, wh = renderer.get_size()
+		if self.entity_store is not None:
+			self.entity_store.render(renderer, rx, ry, now)
+		for ent in self.loose_entities:
+			px, py = ent.get_pos(now)
+			w, h = ent.get_size() or (0, 0)
+			if -w / 2 <= px + rx <= ww + w / 2 and -h / 2 <= py + ry <= wh + h / 2:
+				ent.render(renderer, rx, ry, now)
+		renderer.end_batch()
 
 	def unmap(self, mouse_x, mouse_y):
 		if 0 <= mouse_x and 0 <= mouse_y:
 			cx, cy, rx, ry = self.tileset.unmap(mouse_x, mouse_y)
-			if cx < len(self.layer) and cy < len(self.layer[cx]):
+			if cx < self.width and cy < self.height:
 				return cx, cy, rx, ry
 		return None, None, None, None
 
 	def is_solid(self, x, y):
-		return x < 0 or x >= len(self.layer) or y < 0 or y >= len(self.layer[x]) or self.layer[x][y] in self.solid_tiles
+		return x < 0 or x >= self.width or y < 0 or y >= self.height or (self.solid_columns[x] >> y) & 1 == 1
 
 	def is_type_solid(self, cell):
 		return cell in self.solid_tiles
 
+	def is_edge(self, x, y, dx, dy):
+		# is there a wall edge on the (dx, dy) side of cell (x, y)?
+		return 0 <= x < self.width and 0 <= y < self.height and self.is_solid(x, y) and not self.is_solid(x + dx, y + dy)
+
+	def scan_line(self, i, dep):
+		# finds the merged runs of direction i that lie along grid line dep, in cells.
+		# represented by the (x, y) of the cell to the lower-right. so the two upper-left-corner lines are both (0, 0)
+		# and the two lower-right-corner lines are both (width, height)
+		# this works on a whole line of the solidity bitmaps at once: a cell has an edge if it's solid and its neighbour
+		# isn't (and everything outside of the map counts as solid).
+		dx, dy = DIRECTIONS[i]
+		if dx:
+			# the weird subtraction is to account for the fact that we're in a different cell than the target
+			x = dep - (dx > 0)
+			if not 0 <= x < self.width:
+				return []
+			solid = self.solid_columns[x]
+			neighbour = self.solid_columns[x + dx] if 0 <= x + dx < self.width else -1
+		else:
+			y = dep - (dy > 0)
+			if not 0 <= y < self.height:
+				return []
+			solid = self.solid_rows[y]
+			neighbour = self.solid_rows[y + dy] if 0 <= y + dy < self.height else -1
+		return [(dep, start, end) for start, end in _bit_runs(solid & ~neighbour)]
+
+	def _to_pixels(self, i, runs):
+		# our final representation is (x, y1, y2) where y1 < y2 OR (y, x1, x2) where x1 < x2
+		# we choose that order so that sorting and binary search are easy.
+		if DIRECTIONS[i][0]:
+			ci, cd = self.tileset.cell_size()
+		else:
+			cd, ci = self.tileset.cell_size()
+		return [(dep * cd, idp1 * ci, idp2 * ci) for dep, idp1, idp2 in runs]
+
+	def _line_count(self, i):
+		return self.width + 1 if DIRECTIONS[i][0] else self.height + 1
+
+	def _rebuild_line(self, i, dep):
+		segments = self.segments[i]
+		new = self._to_pixels(i, self.scan_line(i, dep))
+		dep_px = self._to_pixels(i, [(dep, 0, 0)])[0][0]
+		lo = bisect.bisect_left(segments, (dep_px,))
+		hi = bisect.bisect_left(segments, (dep_px, float("inf")), lo)
+		segments[lo:hi] = new
+		lines, index = self.segment_lines[i], self.segment_index[i]
+		if new:
+			if dep_px not in index:
+				bisect.insort(lines, dep_px)
+			index[dep_px] = [start for _, start, _ in new], [end for _, _, end in new]
+		elif dep_px in index:
+			del index[dep_px]
+			del lines[bisect.bisect_left(lines, dep_px)]
+
+	def _rebuild_index(self, i):
+		index = {}
+		for dep, start, end in self.segments[i]:
+			if dep not in index:
+				index[dep] = [], []
+			starts, ends = index[dep]
+			starts.append(start)
+			ends.append(end)
+		self.segment_index[i] = index
+		self.segment_lines[i] = sorted(index)
+
 	def recalculate_cache(self):
 		assert self.cache_dirty
-		for i, direction in enumerate(DIRECTIONS):
-			vertical = not direction[0]
-			# represented by the (x, y) of the cell to the lower-right. so the two upper-left-corner lines are both (0, 0)
-			# and the two lower-right-corner lines are both (width, height)
+		if self.dirty_cells is None:
+			for i in range(len(DIRECTIONS)):
+				runs = []
+				for dep in range(self._line_count(i)):
+					runs += self.scan_line(i, dep)
+				self.segments[i] = self._to_pixels(i, runs)
+				self._rebuild_index(i)
+		else:
+			# a cell only contributes to the lines along its own four edges, so only those need rescanning
 			lines = set()
-			for x, column in enumerate(self.layer):
-				for y, cell in enumerate(column):
-					if self.is_type_solid(cell) and not self.is_solid(x + direction[0], y + direction[1]):
-						# the weird additions are to account for the fact that we're in a different cell than the target
-						rx = x + (direction == DIR_RIGHT)
-						ry = y + (direction == DIR_DOWN)
-						lines.add((ry, rx) if vertical else (rx, ry))
-			# now, that's not our final representation.
-			# our final representation is (x, y1, y2) where y1 < y2 OR (y, x1, x2) where x1 < x2
-			# we choose that order so that sorting and binary search are easy.
-			merged = []
-			while lines:
-				dep, idp = lines.pop()
-				idp1, idp2 = idp, idp
-				while (dep, idp1 - 1) in lines:
-					idp1 -= 1
-					lines.remove((dep, idp1))
-				while (dep, idp2 + 1) in lines:
-					idp2 += 1
-					lines.remove((dep, idp2))
-				merged.append((dep, idp1, idp2 + 1))
-			merged.sort()
-			# ... and now let's make it in pixels instead of cells
-			if vertical:
-				cd, ci = self.tileset.cell_size()
-			else:
-				ci, cd = self.tileset.cell_size()
-			self.segments[i] = [(dep * cd, idp1 * ci, idp2 * ci) for dep, idp1, idp2 in merged]
+			for x, y in self.dirty_cells:
+				for i, (dx, dy) in enumerate(DIRECTIONS):
+					lines.add((i, x if dx else y))
+					lines.add((i, x + 1 if dx else y + 1))
+			for i, dep in lines:
+				self._rebuild_line(i, dep)
+		self.dirty_cells = set()
 		self.cache_dirty = False
 
 	def ray_cast(self, origin, direction, is_vertical, fudge_factor):  # returns distance
-		if self.cache_dirty:
-			self.recalculate_cache()
+		return self.ray_caster.ray_cast(self, origin, direction, is_vertical, fudge_factor)
+
+	def sweep_box(self, center, size, velocity, fudge_factor):  # returns (time, blocked horizontally, blocked vertically)
+		vx, vy = velocity
+		speed = math.sqrt(vx * vx + vy * vy)
+		if speed == 0:
+			return float("inf"), False, False
+		time_horizontal = self.ray_caster.sweep_edge(self, center, size, velocity, False, fudge_factor)
+		time_vertical = self.ray_caster.sweep_edge(self, center, size, velocity, True, fudge_factor)
+		return min(time_horizontal, time_vertical), time_horizontal * speed <= fudge_factor, time_vertical * speed <= fudge_factor
+
+
+def _split_sweep(world, center, size, velocity, is_vertical):
+	# the leading edge of the box, which moves along the independent axis and spans [low, high] on the dependent axis
+	cw, ch = world.tileset.cell_size()
+	if is_vertical:
+		dependent, independent = center
+		half_dependent, half_independent = size[0] / 2, size[1] / 2
+		velocity_dependent, velocity_independent = velocity
+		dependent_extent = world.width * cw
+	else:
+		independent, dependent = center
+		half_independent, half_dependent = size[0] / 2, size[1] / 2
+		velocity_independent, velocity_dependent = velocity
+		dependent_extent = world.height * ch
+	lead = independent + half_independent if velocity_independent > 0 else independent - half_independent
+	return lead, dependent - half_dependent, dependent + half_dependent, velocity_independent, velocity_dependent, dependent_extent
+
+
+def _sweep_margins(velocity_dependent, fudge_factor):
+	# how far a wall has to reach past each end of the edge to count. an end that's moving towards the wall only has to
+	# touch it (within fudge_factor), or else a box sitting exactly on a corner would slip diagonally into it.
+	low_margin = -fudge_factor if velocity_dependent < 0 else fudge_factor
+	high_margin = -fudge_factor if velocity_dependent > 0 else fudge_factor
+	return low_margin, high_margin
+
+
+class SegmentRayCaster:
+	# walks the lines of merged wall segments cached by the world, only looking at the segment under the ray on each
+	def ray_cast(self, world, origin, direction, is_vertical, fudge_factor):
+		if world.cache_dirty:
+			world.recalculate_cache()
+		cw, ch = world.tileset.cell_size()
 		# we will work with HORIZONTAL segments when we're VERTICAL, and vice versa.
 		if is_vertical:
 			dependent, independent = origin
 			direction_dependent, direction_independent = direction
-			segments = self.segments[IDX_DOWN if direction_independent < 0 else IDX_UP]
+			idx = IDX_DOWN if direction_independent < 0 else IDX_UP
+			dependent_extent = world.width * cw
 		else:
 			independent, dependent = origin
 			direction_independent, direction_dependent = direction
-			segments = self.segments[IDX_RIGHT if direction_independent < 0 else IDX_LEFT]
+			idx = IDX_RIGHT if direction_independent < 0 else IDX_LEFT
+			dependent_extent = world.height * ch
 		if direction_independent == 0:
 			return float("inf")  # directly horizontal or vertical
+		lines, index = world.segment_lines[idx], world.segment_index[idx]
 		# slope... or not-quite-slope, depending on orientation
 		slope = direction_dependent / float(direction_independent)
 		# first, find where to start. we use binary search.
 		if direction_independent > 0:  # downwards
-			# we want the leftmost element greater than (independent, -1, -1)
-			start_at = bisect.bisect_right(segments, (independent - fudge_factor, -1, -1))
-			for i in range(start_at, len(segments)):
-				this_independent, dependent_min, dependent_max = segments[i]
-				this_dependent = dependent + slope * (this_independent - independent)
-				if dependent_min + fudge_factor <= this_dependent <= dependent_max - fudge_factor:
-					delta_dependent = this_dependent - dependent
-					delta_independent = this_independent - independent
-					return math.sqrt(delta_dependent * delta_dependent + delta_independent * delta_independent)
-		elif direction_independent < 0:  # upwards
-			# we want the rightmost element less than (independent+1, -1, -1)
-			start_at = bisect.bisect_left(segments, (independent + fudge_factor, -1, -1)) - 1
-			for i in range(start_at, -1, -1):
-				this_independent, dependent_min, dependent_max = segments[i]
-				this_dependent = dependent + slope * (this_independent - independent)
-				if dependent_min + fudge_factor <= this_dependent <= dependent_max - fudge_factor:
-					delta_dependent = this_dependent - dependent
-					delta_independent = this_independent - independent
-					return math.sqrt(delta_dependent * delta_dependent + delta_independent * delta_independent)
+			# we want the first line at or after (independent - fudge_factor)
+			order = range(bisect.bisect_left(lines, independent - fudge_factor), len(lines))
+		else:  # upwards
+			# we want the last line strictly before (independent + fudge_factor)
+			order = range(bisect.bisect_left(lines, independent + fudge_factor) - 1, -1, -1)
+		moving_down = slope * direction_independent >= 0
+		moving_up = slope * direction_independent <= 0
+		for i in order:
+			this_independent = lines[i]
+			this_dependent = dependent + slope * (this_independent - independent)
+			if (this_dependent < 0 and moving_up) or (this_dependent > dependent_extent and moving_down):
+				break  # left the map for good
+			starts, ends = index[this_independent]
+			# the only segment that can contain the hit point is the first one that ends after it
+			k = bisect.bisect_left(ends, this_dependent + fudge_factor)
+			if k < len(ends) and starts[k] + fudge_factor <= this_dependent:
+				delta_dependent = this_dependent - dependent
+				delta_independent = this_independent - independent
+				return math.sqrt(delta_dependent * delta_dependent + delta_independent * delta_independent)
 		# infinite distance when nothing gets hit (which shouldn't happen much in practice)
 		return float("inf")
+
+	def sweep_edge(self, world, center, size, velocity, is_vertical, fudge_factor):  # returns time
+		if world.cache_dirty:
+			world.recalculate_cache()
+		lead, low, high, velocity_independent, velocity_dependent, dependent_extent = _split_sweep(world, center, size, velocity, is_vertical)
+		if velocity_independent == 0:
+			return float("inf")
+		if is_vertical:
+			idx = IDX_DOWN if velocity_independent < 0 else IDX_UP
+		else:
+			idx = IDX_RIGHT if velocity_independent < 0 else IDX_LEFT
+		lines, index = world.segment_lines[idx], world.segment_index[idx]
+		if velocity_independent > 0:
+			order = range(bisect.bisect_left(lines, lead - fudge_factor), len(lines))
+		else:
+			order = range(bisect.bisect_left(lines, lead + fudge_factor) - 1, -1, -1)
+		low_margin, high_margin = _sweep_margins(velocity_dependent, fudge_factor)
+		for i in order:
+			this_independent = lines[i]
+			time = max((this_independent - lead) / velocity_independent, 0)
+			this_low, this_high = low + velocity_dependent * time, high + velocity_dependent * time
+			if (this_high < 0 and velocity_dependent <= 0) or (this_low > dependent_extent and velocity_dependent >= 0):
+				break  # left the map for good
+			starts, ends = index[this_independent]
+			# same as a ray cast, but any point of the edge can hit instead of only a single one
+			k = bisect.bisect_left(ends, this_low + low_margin)
+			if k < len(ends) and starts[k] + high_margin <= this_high:
+				return time
+		return float("inf")
+
+
+class GridRayCaster:
+	# steps through the grid lines crossed by the ray (Amanatides-Woo, but only along the axis that we're tracing)
+	# and looks at the cells on either side of each one, so it doesn't need the segment cache at all.
+	def ray_cast(self, world, origin, direction, is_vertical, fudge_factor):
+		cw, ch = world.tileset.cell_size()
+		if is_vertical:
+			dependent, independent = origin
+			direction_dependent, direction_independent = direction
+			cd, ci = cw, ch
+			line_count, dependent_extent = world.height, world.width * cw
+		else:
+			independent, dependent = origin
+			direction_independent, direction_dependent = direction
+			cd, ci = ch, cw
+			line_count, dependent_extent = world.width, world.height * ch
+		if direction_independent == 0:
+			return float("inf")  # directly horizontal or vertical
+		slope = direction_dependent / float(direction_independent)
+		# same boundary rules as the segment scan: lines within fudge_factor behind us still count when going forward
+		if direction_independent > 0:
+			step, solid_offset = 1, 0
+			line = max(math.ceil((independent - fudge_factor) / ci), 0)
+		else:
+			step, solid_offset = -1, -1
+			line = min(math.ceil((independent + fudge_factor) / ci) - 1, line_count)
+		dependent_step = slope * ci * step
+		while 0 <= line <= line_count:
+			this_independent = line * ci
+			this_dependent = dependent + slope * (this_independent - independent)
+			if (this_dependent < 0 and dependent_step <= 0) or (this_dependent > dependent_extent and dependent_step >= 0):
+				break  # left the map for good
+			# a merged segment covers the hit point iff every cell under [hit - fudge, hit + fudge] has a wall edge here
+			first = math.floor((this_dependent - fudge_factor) / cd)
+			last = math.ceil((this_dependent + fudge_factor) / cd) - 1
+			for cell in range(first, last + 1):
+				if is_vertical:
+					if not world.is_edge(cell, line + solid_offset, 0, -step):
+						break
+				elif not world.is_edge(line + solid_offset, cell, -step, 0):
+					break
+			else:
+				delta_dependent = this_dependent - dependent
+				delta_independent = this_independent - independent
+				return math.sqrt(delta_dependent * delta_dependent + delta_independent * delta_independent)
+			line += step
+		return float("inf")
+
+	def sweep_edge(self, world, center, size, velocity, is_vertical, fudge_factor):  # returns time
+		lead, low, high, velocity_independent, velocity_dependent, dependent_extent = _split_sweep(world, center, size, velocity, is_vertical)
+		if velocity_independent == 0:
+			return float("inf")
+		cw, ch = world.tileset.cell_size()
+		if is_vertical:
+			cd, ci, line_count = cw, ch, world.height
+		else:
+			cd, ci, line_count = ch, cw, world.width
+		if velocity_independent > 0:
+			step, solid_offset = 1, 0
+			line = max(math.ceil((lead - fudge_factor) / ci), 0)
+		else:
+			step, solid_offset = -1, -1
+			line = min(math.ceil((lead + fudge_factor) / ci) - 1, line_count)
+		low_margin, high_margin = _sweep_margins(velocity_dependent, fudge_factor)
+		while 0 <= line <= line_count:
+			time = max((line * ci - lead) / velocity_independent, 0)
+			this_low, this_high = low + velocity_dependent * time, high + velocity_dependent * time
+			if (this_high < 0 and velocity_dependent <= 0) or (this_low > dependent_extent and velocity_dependent >= 0):
+				break  # left the map for good
+			# look at the cells under the edge plus one on each side, which is enough to tell whether a run of wall
+			# edges reaches past the margins.
+			run_start = None
+			for cell in range(math.floor(this_low / cd) - 1, math.ceil(this_high / cd) + 2):
+				if is_vertical:
+					is_edge = world.is_edge(cell, line + solid_offset, 0, -step)
+				else:
+					is_edge = world.is_edge(line + solid_offset, cell, -step, 0)
+				if is_edge and run_start is None:
+					run_start = cell
+				elif not is_edge and run_start is not None:
+					if this_low + low_margin <= cell * cd and run_start * cd + high_margin <= this_high:
+						return time
+					run_start = None
+			if run_start is not None and run_start * cd + high_margin <= this_high:
+				return time
+			line += step
+		return float("inf")